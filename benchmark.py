@@ -0,0 +1,477 @@
+#! /usr/bin/python
+''' Benchmarks for the build listing and update code paths.
+
+    These run outside Kodi against recorded or synthetic data so that
+    regressions in the hot paths can be measured on the device, e.g.
+
+        ./benchmark.py tags
+'''
+
+from __future__ import division
+
+import os
+import re
+import sys
+import bz2
+import time
+import shutil
+import resource
+import tarfile
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+
+from resources.lib.funcs import add_deps_to_path
+add_deps_to_path()
+
+from resources.lib import builds, openelec
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+
+
+TAGS_PAGE = """<html><body>
+<div class="release-timeline">
+{tags}
+</div>
+<div class="pagination">{next}</div>
+</body></html>"""
+
+TAG = """<div class="release-entry">
+  <relative-time datetime="{datetime}">{datetime}</relative-time>
+  <span class="tag-name">{version}</span>
+</div>"""
+
+NEXT = '<a href="{url}?after={version}">Next</a>'
+
+TAGS_PER_PAGE = 10
+
+
+def tag_versions(count, newest=(9, 0)):
+    major, minor = newest
+    return ["{}.{}.{}".format(major, minor - i // 100, 99 - i % 100)
+            for i in range(count)]
+
+
+def record_tag_pages(versions):
+    """Return a dictionary of tags page HTML keyed on URL in the same layout
+       as the GitHub tags pages, newest first."""
+    url = builds.Release.TAGS_URL.format(dist=openelec.dist())
+    pages = {}
+    page_url = url
+    for i in range(0, len(versions), TAGS_PER_PAGE):
+        page_versions = versions[i:i + TAGS_PER_PAGE]
+        tags = "\n".join(TAG.format(version=v, datetime="2016-01-01T00:00:00Z")
+                         for v in page_versions)
+        last = i + TAGS_PER_PAGE >= len(versions)
+        next_link = "" if last else NEXT.format(url=url, version=page_versions[-1])
+        pages[page_url] = TAGS_PAGE.format(tags=tags, next=next_link)
+        page_url = "{}?after={}".format(url, page_versions[-1])
+    return pages
+
+
+def bench_tags(args):
+    requests_made = []
+    pages = {}
+
+    def get_tags_page(cls, url):
+        requests_made.append(url)
+        time.sleep(args.latency)
+        return pages[url]
+
+    builds.Release.get_tags_page = classmethod(get_tags_page)
+    builds.cache_dir = tempfile.mkdtemp()
+
+    def run(version=None):
+        # Simulate a new process.
+        builds.Release.tags = None
+        builds.Release._tags_refreshed = False
+        del requests_made[:]
+        with Timer() as t:
+            builds.Release.maybe_get_tags(version)
+        return t.elapsed, len(requests_made)
+
+    try:
+        versions = tag_versions(args.count + args.new)
+        pages.update(record_tag_pages(versions[args.new:]))
+        results = [("cold fill", run())]
+
+        pages.clear()
+        pages.update(record_tag_pages(versions))
+        results.append(("warm incremental refresh", run(versions[0])))
+        results.append(("warm start", run(versions[0])))
+    finally:
+        shutil.rmtree(builds.cache_dir)
+
+    print "{} tags, {} new, {:.0f} ms simulated latency".format(
+        args.count, args.new, args.latency * 1000)
+    for name, (elapsed, num_requests) in results:
+        print "{:28s} {:8.1f} ms {:4d} requests".format(name, elapsed * 1000,
+                                                       num_requests)
+
+
+LISTING_ROW = ('<tr><td valign="top"><img src="/icons/compressed.gif" alt="[   ]"></td>'
+               '<td><a href="{name}">{name}</a></td>'
+               '<td align="right">2016-01-01 00:00  </td><td align="right">150M</td></tr>')
+
+LISTING_ARCHS = ('Generic.x86_64', 'RPi.arm', 'RPi2.arm', 'imx6.arm', 'WeTek_Play.arm',
+                 'Odroid_C2.aarch64', 'Virtual.x86_64', 'WeTek_Hub.aarch64')
+
+
+def build_names(count):
+    start = datetime(2016, 1, 1)
+    for i in range(count):
+        timestamp = (start + timedelta(hours=i)).strftime(builds.Build.DATETIME_FMT)
+        yield "LibreELEC-{}-devel-{}-r{}-g{:07x}.tar.bz2".format(
+            LISTING_ARCHS[i % len(LISTING_ARCHS)], timestamp, 20000 + i, i)
+
+
+def record_listing(count):
+    """Return the HTML of a directory listing with count build links for a
+       mix of architectures."""
+    rows = "\n".join(LISTING_ROW.format(name=name) for name in build_names(count))
+    return "<html><body><table>\n{}\n</table></body></html>".format(rows)
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_engine(engine, listing_path, queue):
+    with open(listing_path) as f:
+        html = f.read().decode('utf-8')
+    extractor = builds.BuildLinkExtractor("http://localhost/", engine)
+    extractor.build_re = re.compile(
+        extractor.BUILD_RE.format(dist=openelec.dist(), arch=builds.arch), re.I)
+    if engine == 'scan':
+        find_hrefs = lambda html: extractor._scan_hrefs([html])
+    else:
+        find_hrefs = extractor._hrefs
+
+    baseline = max_rss_kb()
+    with Timer() as t:
+        hrefs = list(find_hrefs(html))
+    queue.put((hrefs, t.elapsed, max_rss_kb() - baseline))
+
+
+def run_engine(engine, listing_path):
+    """Run the engine in a separate process so that the peak memory of each
+       run is measured independently."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_engine,
+                                      args=(engine, listing_path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def bench_links(args):
+    print "Arch: {}".format(builds.arch)
+    print "{:>6s} {:6s} {:>8s} {:>12s} {:>10s}".format(
+        "links", "engine", "matches", "links/sec", "peak KB")
+    fd, listing_path = tempfile.mkstemp(suffix='.html')
+    os.close(fd)
+    try:
+        for count in args.counts:
+            with open(listing_path, 'w') as f:
+                f.write(record_listing(count))
+            results = {}
+            for engine in ('soup', 'scan'):
+                hrefs, elapsed, peak_kb = run_engine(engine, listing_path)
+                results[engine] = hrefs
+                print "{:6d} {:6s} {:8d} {:12.0f} {:10d}".format(
+                    count, engine, len(hrefs), count / elapsed, peak_kb)
+            if results['soup'] != results['scan']:
+                print "Engine outputs differ!"
+                sys.exit(1)
+    finally:
+        os.remove(listing_path)
+
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def bench_objects(args):
+    extractor = builds.BuildLinkExtractor("http://localhost/")
+    build_re = re.compile(extractor.BUILD_RE.format(dist='libreelec', arch='.*'), re.I)
+    matches = [(name, build_re.match(name).groups()[:2])
+               for name in build_names(args.count)]
+
+    with Timer() as construct:
+        links = [builds.BuildLink("http://localhost/", name, *groups)
+                 for name, groups in matches]
+
+    with Timer() as sort:
+        links.sort(key=builds.sort_key, reverse=True)
+
+    with Timer() as dates:
+        for link in links:
+            link.date
+    with Timer() as memo_dates:
+        for link in links:
+            link.date
+
+    print "{} build links".format(args.count)
+    print "{:24s} {:8.2f} us/link".format("construct", construct.elapsed / args.count * 1e6)
+    print "{:24s} {:8.2f} ms".format("sort", sort.elapsed * 1000)
+    print "{:24s} {:8.2f} ms".format("format dates", dates.elapsed * 1000)
+    print "{:24s} {:8.2f} ms".format("format dates (memoized)", memo_dates.elapsed * 1000)
+    print "{:24s} {:8d} bytes/link".format("object size", object_size(links[0]))
+
+
+class ListingResponse(object):
+    """Stands in for the response to a request for a directory listing."""
+    encoding = 'utf-8'
+    headers = {'ETag': '"listing"'}
+
+    def __init__(self, html, status_code=200):
+        self.text = html
+        self.status_code = status_code
+
+    def __nonzero__(self):
+        return True
+
+    def iter_content(self, chunk_size):
+        content = self.text.encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+
+class ListingSession(object):
+    """Serves the same listing for every URL and reports it as unchanged
+       when the request is conditional."""
+    def __init__(self, html):
+        self.html = html
+
+    def get(self, url, headers={}, **kwargs):
+        if 'If-None-Match' in headers:
+            return ListingResponse(u'', 304)
+        return ListingResponse(self.html)
+
+
+def bench_newest(args):
+    html = record_listing(args.count).decode('utf-8')
+    listing_session = ListingSession(html)
+    builds.session = lambda: listing_session
+    build_url = builds.BuildsURL("http://localhost/", engine=args.engine)
+
+    def run(method, *method_args):
+        with Timer() as t:
+            for i in range(args.repeat):
+                build_url.invalidate()
+                result = method(*method_args)
+        return result, t.elapsed / args.repeat
+
+    def run_all():
+        latest, full = run(build_url.latest)
+        newest, check = run(build_url.newest)
+        if not newest == latest:
+            print "Newest build differs from the full listing!"
+            sys.exit(1)
+        _, current_check = run(build_url.newest, latest)
+        return latest, [("full listing", full), ("newest only", check),
+                        ("newest only (up to date)", current_check)]
+
+    builds.cache_dir = None
+    latest, results = run_all()
+
+    # Now the hrefs are stored and every request is answered with a 304.
+    builds.cache_dir = tempfile.mkdtemp()
+    try:
+        build_url.invalidate()
+        build_url.builds()
+        _, cached_results = run_all()
+    finally:
+        shutil.rmtree(builds.cache_dir)
+
+    print "{} links, {} engine, newest {}".format(args.count, args.engine, latest)
+    print "{:28s} {:>10s} {:>14s}".format("", "changed", "not modified")
+    for (name, elapsed), (_, cached_elapsed) in zip(results, cached_results):
+        print "{:28s} {:7.2f} ms {:11.2f} ms".format(name, elapsed * 1000,
+                                                    cached_elapsed * 1000)
+
+
+def write_synthetic_tar(path, size_mb):
+    """Write a bz2 compressed tar of about size_mb MB with update images made
+       of incompressible data, like a squashfs image, and text."""
+    words = [os.urandom(n).encode('hex') for n in range(2, 12)] * 50
+    text = ' '.join(words[i * 7 % len(words)] for i in range(20000))
+    block_size = 1024 * 1024
+    compressor = bz2.BZ2Compressor()
+    with open(path, 'wb') as f:
+        def write(data):
+            f.write(compressor.compress(data))
+
+        for name, mb in (('SYSTEM', size_mb - size_mb // 10), ('KERNEL', size_mb // 10)):
+            info = tarfile.TarInfo('Update/target/' + name)
+            info.size = mb * block_size
+            write(info.tobuf())
+            for i in range(mb):
+                if i % 2:
+                    write(os.urandom(block_size))
+                else:
+                    write((text * (block_size // len(text) + 1))[:block_size])
+        write('\0' * tarfile.RECORDSIZE)
+        f.write(compressor.flush())
+
+
+def bench_decompress(args):
+    from resources.lib import decompress
+
+    fd, path = tempfile.mkstemp(suffix='.tar.bz2')
+    os.close(fd)
+    try:
+        print "Writing a {} MB synthetic tar ...".format(args.size)
+        write_synthetic_tar(path, args.size)
+        compressed_size = os.path.getsize(path)
+
+        decompress.pool_type = args.pool
+        decompress.workers = args.workers
+        print "{} MB compressed, {} workers ({})".format(
+            compressed_size // (1024 * 1024),
+            args.workers or multiprocessing.cpu_count(), args.pool)
+        print "{:10s} {:>10s} {:>12s}".format("engine", "seconds", "MB/s out")
+
+        for name, parallel in (('serial', False), ('parallel', True)):
+            decompressor = decompress.bz2_decompressor(parallel)
+            out_size = 0
+            with Timer() as t, open(path, 'rb') as f:
+                for data in iter(lambda: f.read(131072), ''):
+                    out_size += len(decompressor.decompress(data))
+                out_size += len(decompressor.flush())
+            print "{:10s} {:10.2f} {:12.1f}".format(
+                type(decompressor).__name__.replace('BZ2Decompressor', '').lower(),
+                t.elapsed, out_size / t.elapsed / (1024 * 1024))
+    finally:
+        os.remove(path)
+
+
+def synthetic_builds(count, size_mb, changes):
+    """Yield update tars for consecutive builds of size_mb MB in which the
+       SYSTEM image changes in a few places between builds, including data
+       which is inserted, and the KERNEL image changes every fifth build."""
+    block_size = 1024 * 1024
+    system = bytearray(os.urandom((size_mb - size_mb // 10) * block_size))
+    kernel = os.urandom(size_mb // 10 * block_size)
+    for build in range(count):
+        if build:
+            for i in range(changes):
+                pos = int(len(system) * (i + 0.5) / changes) + build * 4096
+                system[pos:pos + 20000] = os.urandom(20000 + (i % 2) * 5000)
+            if build % 5 == 0:
+                kernel = os.urandom(len(kernel))
+        tar = []
+        for name, data in (('SYSTEM', str(system)), ('KERNEL', kernel)):
+            info = tarfile.TarInfo('Update/target/' + name)
+            info.size = len(data)
+            tar.extend((info.tobuf(), data, '\0' * (-len(data) % tarfile.BLOCKSIZE)))
+        tar.append('\0' * tarfile.RECORDSIZE)
+        yield ''.join(tar)
+
+
+def bench_dedup(args):
+    from resources.lib import chunkstore
+
+    store_path = tempfile.mkdtemp()
+    try:
+        store = chunkstore.ChunkStore(os.path.join(store_path, chunkstore.STORE_NAME))
+        print "{:>6s} {:>10s} {:>10s} {:>10s} {:>12s}".format(
+            "build", "MB", "new MB", "write s", "restore MB/s")
+        recipes = []
+        for build, tar in enumerate(synthetic_builds(args.builds, args.size, args.changes)):
+            recipe_path = os.path.join(store_path, "build{}{}".format(build, chunkstore.RECIPE_EXT))
+            writer = store.writer(recipe_path)
+            with Timer() as write_time:
+                for i in range(0, len(tar), 131072):
+                    writer.write(tar[i:i + 131072])
+                writer.commit()
+            recipes.append(recipe_path)
+
+            reader = store.reader(recipe_path)
+            with Timer() as read_time:
+                restored = 0
+                for data in iter(lambda: reader.read(131072), ''):
+                    restored += len(data)
+            assert restored == len(tar)
+            print "{:6d} {:10.1f} {:10.1f} {:10.2f} {:12.1f}".format(
+                build, len(tar) / (1024 * 1024), writer.new_size / (1024 * 1024),
+                write_time.elapsed, restored / read_time.elapsed / (1024 * 1024))
+
+        logical, stored = store.logical_size(), store.stored_size()
+        print "{:.1f} MB archived in {:.1f} MB, dedup ratio {:.2f}".format(
+            logical / (1024 * 1024), stored / (1024 * 1024), logical / stored)
+    finally:
+        shutil.rmtree(store_path)
+
+
+parser = ArgumentParser(description='Run add-on benchmarks')
+subparsers = parser.add_subparsers()
+
+tags_parser = subparsers.add_parser(
+    'tags', help='compare a cold fill of the release tag dates with a warm refresh')
+tags_parser.add_argument('--count', type=int, default=300,
+                         help='number of existing tags (default: %(default)s)')
+tags_parser.add_argument('--new', type=int, default=3,
+                         help='number of new tags for the refresh (default: %(default)s)')
+tags_parser.add_argument('--latency', type=float, default=0.1,
+                         help='simulated seconds per request (default: %(default)s)')
+tags_parser.set_defaults(func=bench_tags)
+
+links_parser = subparsers.add_parser(
+    'links', help='compare the link extractor engines on large directory listings')
+links_parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 10000],
+                          help='numbers of links in the listings (default: %(default)s)')
+links_parser.set_defaults(func=bench_links)
+
+objects_parser = subparsers.add_parser(
+    'objects', help='construct and sort build links as for a large archive listing')
+objects_parser.add_argument('--count', type=int, default=10000,
+                            help='number of build links (default: %(default)s)')
+objects_parser.set_defaults(func=bench_objects)
+
+newest_parser = subparsers.add_parser(
+    'newest', help='compare the newest build check with the full listing')
+newest_parser.add_argument('--count', type=int, default=10000,
+                           help='number of links in the listing (default: %(default)s)')
+newest_parser.add_argument('--engine', choices=('soup', 'scan'), default='scan',
+                           help='link extractor engine (default: %(default)s)')
+newest_parser.add_argument('--repeat', type=int, default=5,
+                           help='number of runs to average (default: %(default)s)')
+newest_parser.set_defaults(func=bench_newest)
+
+decompress_parser = subparsers.add_parser(
+    'decompress', help='compare serial and parallel bz2 decompression of a synthetic tar')
+decompress_parser.add_argument('--size', type=int, default=200,
+                               help='size of the tar in MB (default: %(default)s)')
+decompress_parser.add_argument('--workers', type=int,
+                               help='number of workers (default: number of cores)')
+decompress_parser.add_argument('--pool', choices=('process', 'thread'), default='process',
+                               help='type of worker pool (default: %(default)s)')
+decompress_parser.set_defaults(func=bench_decompress)
+
+dedup_parser = subparsers.add_parser(
+    'dedup', help='archive consecutive synthetic builds in the chunk store')
+dedup_parser.add_argument('--builds', type=int, default=10,
+                          help='number of builds (default: %(default)s)')
+dedup_parser.add_argument('--size', type=int, default=50,
+                          help='size of each build in MB (default: %(default)s)')
+dedup_parser.add_argument('--changes', type=int, default=20,
+                          help='changes to the SYSTEM image per build (default: %(default)s)')
+dedup_parser.set_defaults(func=bench_dedup)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.func(args)
@@ -21,18 +21,21 @@ from __future__ import division
 
 import os
 import sys
-import tarfile
-from contextlib import closing
 
 import xbmc, xbmcgui, xbmcaddon, xbmcvfs
 import requests
 
 from resources.lib import (progress, script_exceptions, utils, builds, openelec,
-                           rpi, addon, log, gui, funcs)
+                           rpi, addon, log, gui, funcs, transfer, verify, decompress,
+                           archive, history, chunkstore, delta)
 from resources.lib.addon import L10n
 
 TEMP_PATH = xbmc.translatePath("special://temp/")
 
+# Seconds to spend finding the chunks of a delta update in the local files
+# before downloading the full build instead.
+DELTA_SEED_TIMEOUT = 120
+
 
 class Main(object):
     def __enter__(self):
@@ -61,6 +64,9 @@ class Main(object):
 
         self.background = addon.get_bool_setting('background')
         self.verify_files = addon.get_bool_setting('verify_files')
+        self.verifier = None
+        self.archive_md5sums = None
+        self.archive_tar_size = None
         
         funcs.create_directory(openelec.UPDATE_DIR)
 
@@ -71,6 +77,8 @@ class Main(object):
 
         self.select_build()
 
+        builds.log_stats()
+
         utils.remove_update_files()
 
         self.check_archive()
@@ -133,6 +141,9 @@ class Main(object):
             self.archive_root = utils.ensure_trailing_slash(archive_root)
             self.archive_tar_path = None
             self.archive_dir = os.path.join(self.archive_root, str(self.selected_source))
+            self.archive_dedup = addon.get_bool_setting('archive_dedup')
+            self.chunk_store = chunkstore.ChunkStore(
+                os.path.join(self.archive_root, chunkstore.STORE_NAME))
             log.log("Archive builds to " + self.archive_dir)
             if not xbmcvfs.exists(self.archive_root):
                 log.log("Unable to access archive")
@@ -144,13 +155,16 @@ class Main(object):
                 utils.ok(L10n(32009), L10n(32012).format(self.archive_dir), L10n(32013))
                 sys.exit(1)
 
-    def maybe_download(self):
+    def get_remote_file(self):
         try:
-            remote_file = self.selected_build.remote_file()
+            return self.selected_build.remote_file()
         except requests.RequestException as e:
             utils.url_error(self.selected_build.url, str(e))
             sys.exit(1)
 
+    def maybe_download(self):
+        remote_file = self.get_remote_file()
+
         filename = self.selected_build.filename
         tar_name = self.selected_build.tar_name
         size = self.selected_build.size
@@ -160,64 +174,201 @@ class Main(object):
         self.update_tar_path = os.path.join(openelec.UPDATE_DIR, tar_name)
         if self.archive:
             self.archive_tar_path = os.path.join(self.archive_dir, tar_name)
+            if self.archive_dedup:
+                self.archive_tar_path += chunkstore.RECIPE_EXT
         
         if not self.copy_from_archive():
-            if (os.path.isfile(self.download_path) and
-                    os.path.getsize(self.download_path) == size):
-                    # Skip the download if the file exists with the correct size.
-                log.log("Skipping download")
-            else:
-                try:
-                    log.log("Starting download of {} to {}".format(self.selected_build.url,
-                                                                   self.download_path))
-                    with progress.FileProgress(L10n(32014), remote_file, self.download_path,
-                                               size, self.background) as downloader:
-                        downloader.start()
-                    log.log("Completed download")
-                except script_exceptions.Canceled:
-                    sys.exit(0)
-                except requests.RequestException as e:
-                    utils.url_error(self.selected_build.url, str(e))
-                    sys.exit(1)
-                except script_exceptions.WriteError as e:
-                    utils.write_error(self.download_path, str(e))
-                    sys.exit(1)
-
-            if self.selected_build.compressed:
-                try:
-                    bf = open(self.download_path, 'rb')
-                    log.log("Starting decompression of " + self.download_path)
-                    with progress.DecompressProgress(L10n(32015),
-                                                     bf, self.temp_tar_path, size,
-                                                     self.background) as decompressor:
-                        decompressor.start()
-                    log.log("Completed decompression")
-                except script_exceptions.Canceled:
-                    sys.exit(0)
-                except script_exceptions.WriteError as e:
-                    utils.write_error(self.temp_tar_path, str(e))
-                    sys.exit(1)
-                except script_exceptions.DecompressError as e:
-                    utils.decompress_error(self.download_path, str(e))
-                    sys.exit(1)
-                finally:
-                    funcs.remove_file(self.download_path)
+            if not self.maybe_delta_update(remote_file):
+                if remote_file.closed:
+                    # A delta update was tried so request the build again.
+                    remote_file = self.get_remote_file()
+                connections = addon.get_int_setting('connections')
+                if connections > 1:
+                    self.download(remote_file, size, connections)
+                    if self.selected_build.compressed:
+                        self.decompress(size)
+                else:
+                    self.download_and_decompress(remote_file, size)
 
             self.maybe_copy_to_archive()
         
             log.log("Moving tar file to " + self.update_tar_path)
             os.renames(self.temp_tar_path, self.update_tar_path)
 
+        self.maybe_update_archive_index()
+
         addon.set_setting('update_pending', 'true')
 
+    def delta_seeds(self):
+        """Return the local files which may have chunks of the new build."""
+        seeds = [os.path.join(openelec.FLASH_DIR, image)
+                 for image in openelec.UPDATE_IMAGES]
+        if self.archive:
+            latest = archive.ArchiveIndex(self.archive_root).latest(self.selected_source)
+            if latest is not None and not latest.endswith(chunkstore.RECIPE_EXT):
+                seeds.append(archive.local_path(latest))
+        return [path for path in seeds if path is not None and os.path.isfile(path)]
+
+    def maybe_delta_update(self, remote_file):
+        """Rebuild the update tar from the chunks which are already on this
+           system and fetch only the rest, if the source publishes a chunk
+           index for the build. Return True if the tar was rebuilt.
+
+           The remote file is closed if a delta update is tried, rather than
+           leaving the connection idle while the local files are read."""
+        if not addon.get_bool_setting('delta_updates'):
+            return False
+
+        index_url = delta.index_url(self.selected_build.url)
+        index = delta.fetch_index(index_url)
+        if index is None:
+            return False
+        remote_file.close()
+
+        verifier = verify.TarVerifier() if self.verify_files else None
+        try:
+            update = delta.DeltaUpdate(index, index_url, self.temp_tar_path, verifier)
+        except script_exceptions.DeltaError as e:
+            log.log("Unable to use chunk index {}: {}".format(index_url, e))
+            return False
+
+        if not progress.find_delta_chunks(update, self.delta_seeds(), self.background,
+                                          DELTA_SEED_TIMEOUT):
+            log.log("Downloading the full build instead of a delta update")
+            return False
+        if self.archive and self.archive_dedup:
+            update.add_store(self.chunk_store)
+
+        try:
+            update.open()
+            with progress.DownloadProgress(L10n(32014), update,
+                                           self.background) as downloader:
+                downloader.start()
+        except script_exceptions.Canceled:
+            sys.exit(0)
+        except script_exceptions.WriteError as e:
+            utils.write_error(self.temp_tar_path, str(e))
+            sys.exit(1)
+        except (requests.RequestException, script_exceptions.DeltaError) as e:
+            log.log("Delta update failed so downloading the full build: {}".format(e))
+            return False
+
+        self.verifier = verifier
+        return True
+
+    def download(self, remote_file, size, connections):
+        download = transfer.create_download(
+            self.selected_build.url, self.download_path, size, connections)
+        if download.is_complete():
+            # Skip the download if the file was completed in a previous run.
+            log.log("Skipping download")
+            return
+
+        try:
+            log.log("Starting download of {} to {}".format(self.selected_build.url,
+                                                           self.download_path))
+            download.open(remote_file)
+            with progress.DownloadProgress(L10n(32014), download,
+                                           self.background) as downloader:
+                downloader.start()
+            log.log("Completed download")
+        except script_exceptions.Canceled:
+            sys.exit(0)
+        except requests.RequestException as e:
+            utils.url_error(self.selected_build.url, str(e))
+            sys.exit(1)
+        except script_exceptions.WriteError as e:
+            utils.write_error(self.download_path, str(e))
+            sys.exit(1)
+
+    def decompress(self, size):
+        try:
+            bf = open(self.download_path, 'rb')
+            log.log("Starting decompression of " + self.download_path)
+            with progress.DecompressProgress(L10n(32015),
+                                             bf, self.temp_tar_path, size,
+                                             self.background) as decompressor:
+                decompressor.start()
+            log.log("Completed decompression")
+        except script_exceptions.Canceled:
+            sys.exit(0)
+        except script_exceptions.WriteError as e:
+            utils.write_error(self.temp_tar_path, str(e))
+            sys.exit(1)
+        except script_exceptions.DecompressError as e:
+            utils.decompress_error(self.download_path, str(e))
+            sys.exit(1)
+        finally:
+            funcs.remove_file(self.download_path)
+
+    def download_and_decompress(self, remote_file, size):
+        """Download, decompress and verify the update file in a single pass."""
+        if self.verify_files:
+            self.verifier = verify.TarVerifier()
+
+        tee = None
+        if self.archive and not xbmcvfs.exists(self.archive_tar_path):
+            if self.archive_dedup:
+                tee = archive.ArchiveWriter(self.archive_tar_path,
+                                            target=self.chunk_store.writer(self.archive_tar_path))
+            elif not archive.same_file_system(TEMP_PATH, self.archive_dir):
+                tee = archive.ArchiveWriter(self.archive_tar_path)
+            if tee is not None:
+                log.log("Archiving tar file to {} during download".format(self.archive_tar_path))
+
+        try:
+            try:
+                download = transfer.Download(self.selected_build.url, self.download_path, size)
+                pipeline = transfer.Pipeline(download, self.temp_tar_path,
+                                             self.selected_build.compressed, self.verifier, tee)
+                log.log("Starting download of {} to {}".format(self.selected_build.url,
+                                                               self.temp_tar_path))
+                pipeline.open(remote_file)
+                with progress.DownloadProgress(L10n(32014), pipeline,
+                                               self.background) as downloader:
+                    downloader.start()
+            except:
+                # Remove the partial archive file however the download fails.
+                if tee is not None:
+                    tee.abort()
+                raise
+            log.log("Completed download")
+        except script_exceptions.Canceled:
+            sys.exit(0)
+        except requests.RequestException as e:
+            utils.url_error(self.selected_build.url, str(e))
+            sys.exit(1)
+        except script_exceptions.WriteError as e:
+            utils.write_error(self.temp_tar_path, str(e))
+            sys.exit(1)
+        except script_exceptions.DecompressError as e:
+            utils.decompress_error(self.download_path, str(e))
+            sys.exit(1)
+
     def copy_from_archive(self):
         if self.archive and xbmcvfs.exists(self.archive_tar_path):
             log.log("Skipping download and decompression")
 
-            archive = xbmcvfs.File(self.archive_tar_path)
+            if self.verify_files:
+                self.archive_md5sums = archive.verified_md5sums(self.archive_tar_path)
+
+            if self.archive_dedup:
+                try:
+                    archive_file = self.chunk_store.reader(self.archive_tar_path)
+                except (IOError, ValueError) as e:
+                    log.log("Unable to read {}: {}".format(self.archive_tar_path, e))
+                    return False
+            elif archive.link_file(self.archive_tar_path, self.update_tar_path):
+                self.archive_tar_size = os.path.getsize(self.update_tar_path)
+                return True
+            else:
+                archive_file = xbmcvfs.File(self.archive_tar_path)
+
+            self.archive_tar_size = archive_file.size()
             try:
                 with progress.FileProgress(L10n(32016),
-                                           archive, self.update_tar_path, archive.size(),
+                                           archive_file, self.update_tar_path,
+                                           self.archive_tar_size,
                                            self.background) as extractor:
                     extractor.start()
             except script_exceptions.Canceled:
@@ -225,6 +376,11 @@ class Main(object):
                 sys.exit(0)
             except script_exceptions.WriteError:
                 sys.exit(1)
+            except IOError as e:
+                # A chunk is missing or corrupt so download the build instead.
+                log.log("Unable to restore {}: {}".format(self.archive_tar_path, e))
+                self.archive_md5sums = None
+                return False
             return True
         return False
 
@@ -232,6 +388,13 @@ class Main(object):
         if self.archive and not xbmcvfs.exists(self.archive_tar_path):
             log.log("Archiving tar file to {}".format(self.archive_tar_path))
 
+            if self.archive_dedup:
+                self.copy_to_chunk_store()
+                return
+
+            if archive.link_file(self.temp_tar_path, self.archive_tar_path):
+                return
+
             tar = open(self.temp_tar_path)
             size = os.path.getsize(self.temp_tar_path)
 
@@ -247,45 +410,73 @@ class Main(object):
                 utils.write_error(self.archive_tar_path, str(e))
                 xbmcvfs.delete(self.archive_tar_path)
 
+    def copy_to_chunk_store(self):
+        writer = self.chunk_store.writer(self.archive_tar_path)
+        try:
+            with open(self.temp_tar_path, 'rb') as tar:
+                for data in iter(lambda: tar.read(progress.FileProgress.BLOCK_SIZE), ''):
+                    writer.write(data)
+            writer.commit()
+        except (IOError, OSError) as e:
+            utils.write_error(self.archive_tar_path, str(e))
+            writer.discard()
+
+    def maybe_update_archive_index(self):
+        """Record the archived tar in the archive index and remove the least
+           recently installed builds if the archive is over its limits."""
+        if not (self.archive and xbmcvfs.exists(self.archive_tar_path)):
+            return
+
+        index = archive.ArchiveIndex(self.archive_root)
+        index.add(self.selected_source, os.path.basename(self.archive_tar_path),
+                  self.selected_build.version, archive.file_stat(self.archive_tar_path)[0])
+
+        max_size = addon.get_int_setting('archive_max_size') * 1024**3
+        max_count = addon.get_int_setting('archive_max_count')
+        if max_size or max_count:
+            keep = history.get_marked_builds() or set()
+            keep.add((str(self.selected_source), self.selected_build.version))
+            keep.update((source, self.installed_build.version) for source in index.sources())
+            index.enforce(max_size, max_count, keep, history.get_last_install_times() or {})
+
+        index.save()
+
     def maybe_verify(self):
         if not self.verify_files:
             return
 
-        log.log("Verifying update file")
-        with closing(tarfile.open(self.update_tar_path, 'r')) as tf:
-            tar_names = tf.getnames()
-
+        if (self.archive_md5sums is not None and
+                os.path.getsize(self.update_tar_path) == self.archive_tar_size):
             for update_image in openelec.UPDATE_IMAGES:
-                path_in_tar = next(name for name in tar_names
-                                   if name.endswith(os.path.join('target', update_image)))
-                ti = tf.extractfile(path_in_tar)
-                temp_image_path = os.path.join(TEMP_PATH, update_image)
-                try:
-                    with progress.FileProgress(L10n(32018), ti, temp_image_path, ti.size,
-                                               self.background) as extractor:
-                        extractor.start()
-                    log.log("Extracted " + temp_image_path)
-                except script_exceptions.Canceled:
-                    return
-                except script_exceptions.WriteError as e:
-                    utils.write_error(temp_image_path, str(e))
-                    return
-
-                md5sum = tf.extractfile(path_in_tar + '.md5').read().split()[0]
-                log.log("{}.md5 file = {}".format(update_image, md5sum))
-        
-                if not progress.md5sum_verified(md5sum, temp_image_path,
-                                                self.background):
-                    log.log("{} md5 mismatch!".format(update_image))
-                    utils.ok(L10n(32019).format(update_image),
-                             self.selected_build.filename,
-                             L10n(32020).format(update_image), L10n(32021))
-                    utils.remove_update_files()
-                    return
-                else:
-                    log.log("{} md5 is correct".format(update_image))
+                log.log("{} md5 = {} from archive manifest".format(
+                    update_image, self.archive_md5sums[update_image]))
+            log.log("Skipping verification of archived update file")
+            return
 
-                funcs.remove_file(temp_image_path)
+        log.log("Verifying update file")
+        verifier = self.verifier
+        if verifier is None:
+            verifier = progress.verify_tar(self.update_tar_path, self.background)
+            if verifier is None:
+                return
+
+        for update_image in openelec.UPDATE_IMAGES:
+            log.log("{}.md5 file = {}".format(update_image,
+                                             verifier.expected.get(update_image)))
+            if not verifier.verified(update_image):
+                log.log("{} md5 mismatch!".format(update_image))
+                utils.ok(L10n(32019).format(update_image),
+                         self.selected_build.filename,
+                         L10n(32020).format(update_image), L10n(32021))
+                utils.remove_update_files()
+                if self.archive:
+                    archive.remove_manifest(self.archive_tar_path)
+                return
+            else:
+                log.log("{} md5 is correct".format(update_image))
+
+        if self.archive and xbmcvfs.exists(self.archive_tar_path):
+            archive.write_manifest(self.archive_tar_path, verifier.md5sums)
 
     def confirm(self):
         funcs.create_notify_file(self.selected_source, self.selected_build)
@@ -345,8 +536,13 @@ def new_build_check():
 
         log.log("Checking {}".format(build_url.url))
 
-        latest = builds.latest_build(source)
-        if latest and latest > installed_build:
+        try:
+            latest = build_url.newest(installed_build)
+        except (requests.RequestException, builds.BuildURLError) as e:
+            log.log("Unable to check for a new build: {}".format(e))
+            return
+        builds.log_stats()
+        if latest:
             if utils.do_show_dialog():
                 log.log("New build {} is available, "
                         "prompting to show build list".format(latest))
@@ -364,6 +560,27 @@ def new_build_check():
                              4000)
 
 
+def prefetch_sources():
+    """Save a snapshot of the builds and build info of every source so that
+       the build select dialog can open without waiting for the network."""
+    builds.arch = utils.get_arch()
+
+    if addon.get_bool_setting('set_timeout'):
+        builds.timeout = float(addon.get_setting('timeout'))
+
+    build_sources = builds.sources()
+    utils.add_custom_sources(build_sources, quiet=True)
+
+    for source, build_url in build_sources.iteritems():
+        log.log("Prefetching {}".format(source))
+        try:
+            builds.refresh_snapshot(source, build_url)
+        except (requests.RequestException, builds.BuildURLError) as e:
+            log.log("Unable to prefetch {}: {}".format(source, e))
+
+    builds.log_stats()
+
+
 log.log_version()
 log.log("Script arguments: {}".format(sys.argv))
 
@@ -373,6 +590,9 @@ else:
     builds.date_fmt = xbmc.getRegion('dateshort')
 log.log("Set date format to {}".format(builds.date_fmt))
 
+builds.cache_dir = os.path.join(addon.data_path, 'cache')
+decompress.pool_type = 'thread'
+
 if len(sys.argv) > 1:
     if sys.argv[1] == 'checkperiodic':
         if addon.get_bool_setting('check'):
@@ -384,6 +604,9 @@ if len(sys.argv) > 1:
         if addon.get_bool_setting('check'):
             new_build_check()
 
+    elif sys.argv[1] == 'prefetch':
+        prefetch_sources()
+
     elif sys.argv[1] == 'confirm':
         selected = builds.get_build_from_notify_file()
         if selected:
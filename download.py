@@ -21,16 +21,17 @@
 import sys
 import os
 import time
+import functools
 from argparse import ArgumentParser
 from urlparse import urlparse
-import bz2
+from contextlib import closing
 
 from resources.lib.funcs import size_fmt, add_deps_to_path
 add_deps_to_path()
 
 import requests
 
-from resources.lib import builds, openelec, funcs
+from resources.lib import builds, openelec, funcs, transfer, decompress
 
 
 parser = ArgumentParser(description='Download an OpenELEC update')
@@ -39,6 +40,8 @@ parser.add_argument('-a', '--arch',
 parser.add_argument('-s', '--source', help='Set the build source')
 parser.add_argument('-r', '--releases', action='store_true',
                     help='Look for unofficial releases instead of development builds')
+parser.add_argument('-c', '--connections', type=int, default=1,
+                    help='Set the number of connections used for the download')
 
 args = parser.parse_args()
 
@@ -115,11 +118,17 @@ print "Installed build: {}".format(installed_build)
 def read(f):
     return f.read(131072)
 
-decompressor = bz2.BZ2Decompressor()
-def decompress(f):
+decompressor = None
+def read_decompressed(f):
     data = read(f)
     return decompressor.decompress(data)
 
+def show_progress(start_time, start_done, size, done):
+    percent = int(done * 100 / size)
+    bytes_per_second = (done - start_done) / (time.time() - start_time)
+    print "\r {0:3d}%   ({1}/s)   ".format(percent, size_fmt(bytes_per_second)),
+    sys.stdout.flush()
+
 def process(fin, fout, size, read_func=read):
     start_time = time.time()
     done = 0
@@ -127,14 +136,13 @@ def process(fin, fout, size, read_func=read):
         data = read_func(fin)
         done = fin.tell()
         fout.write(data)
-        percent = int(done * 100 / size)
-        bytes_per_second = done / (time.time() - start_time)
-        print "\r {0:3d}%   ({1}/s)   ".format(percent, size_fmt(bytes_per_second)),
-        sys.stdout.flush()
+        show_progress(start_time, 0, size, done)
+    if read_func is read_decompressed:
+        fout.write(decompressor.flush())
     print
 
 try:
-    links = build_url.builds()
+    links = builds.resolve_dates(build_url.builds())
 except requests.RequestException as e:
     print str(e)
 except builds.BuildURLError as e:
@@ -144,24 +152,51 @@ else:
         build = get_choice(links, build_suffix, reverse=True)
         remote = build.remote_file()
         file_path = os.path.join(openelec.UPDATE_DIR, build.filename)
+        tar_path = os.path.join(openelec.UPDATE_DIR, build.tar_name)
         print
         print "Downloading {0} ...".format(build.url)
+        download = transfer.create_download(build.url, file_path, build.size,
+                                            args.connections)
         try:
-            with open(file_path, 'w') as out:
-                process(remote, out, build.size)
+            if args.connections == 1:
+                # Decompress while downloading.
+                download = transfer.Pipeline(download, tar_path, build.compressed)
+            download.open(remote)
+            if download.offset:
+                print "Resuming at {}".format(size_fmt(download.offset))
+            with closing(download):
+                start_time = time.time()
+                download.run(functools.partial(show_progress, start_time,
+                                               download.offset, build.size))
+            print
         except KeyboardInterrupt:
-            os.remove(file_path)
             print
             print "Download cancelled"
+            if download.resumable:
+                print "Run again to resume the download"
             sys.exit()
+        except requests.RequestException as e:
+            print
+            print str(e)
+            if download.resumable:
+                print "Run again to resume the download"
+            sys.exit(1)
+        except IOError as e:
+            print
+            print str(e)
+            sys.exit(1)
 
-        if build.compressed:
-            tar_path = os.path.join(openelec.UPDATE_DIR, build.tar_name)
+        if build.compressed and args.connections > 1:
             size = os.path.getsize(file_path)
             print
             print "Decompressing {0} ...".format(file_path)
+            try:
+                decompressor = decompress.decompressor(file_path)
+            except IOError as e:
+                print str(e)
+                sys.exit(1)
             with open(file_path, 'r') as fin, open(tar_path, 'w') as fout:
-                process(fin, fout, size, decompress)
+                process(fin, fout, size, read_decompressed)
             os.remove(file_path)
 
         funcs.create_notify_file(source, build)
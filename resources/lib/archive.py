@@ -0,0 +1,388 @@
+''' Module for the update files kept in the build archive '''
+
+import os
+import json
+import time
+import threading
+from collections import deque, Counter
+
+import xbmc, xbmcvfs
+
+import log, openelec, funcs, chunkstore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+MANIFEST_EXT = '.manifest'
+PART_EXT = '.part'
+INDEX_NAME = '.archive_index.json'
+
+# The Linux ioctl which makes a copy on write clone of a file (btrfs, xfs).
+FICLONE = 0x40049409
+
+
+def manifest_path(tar_path):
+    return tar_path + MANIFEST_EXT
+
+
+def file_stat(path):
+    """Return the size and modification time of the file."""
+    st = xbmcvfs.Stat(path)
+    return st.st_size(), st.st_mtime()
+
+
+@log.with_logging(msg_error="Unable to read verification manifest for {0}")
+def read_manifest(tar_path):
+    f = xbmcvfs.File(manifest_path(tar_path))
+    try:
+        return json.loads(f.read())
+    finally:
+        f.close()
+
+
+@log.with_logging(msg_success="Wrote verification manifest for {0}",
+                  msg_error="Unable to write verification manifest for {0}")
+def write_manifest(tar_path, md5sums):
+    """Record the verified md5 of each update image in a manifest next to
+       the archived tar along with the size and modification time of the tar."""
+    size, mtime = file_stat(tar_path)
+    manifest = {'size': size, 'mtime': mtime, 'md5sums': md5sums}
+    f = xbmcvfs.File(manifest_path(tar_path), 'w')
+    try:
+        if not f.write(json.dumps(manifest)):
+            raise IOError("Write failed")
+    finally:
+        f.close()
+
+
+def remove_manifest(tar_path):
+    path = manifest_path(tar_path)
+    if xbmcvfs.exists(path):
+        xbmcvfs.delete(path)
+
+
+def verified_md5sums(tar_path, images=openelec.UPDATE_IMAGES):
+    """Return the md5 of each update image from the manifest of the archived
+       tar, or None if there is no manifest or the tar has changed since it
+       was verified."""
+    if not xbmcvfs.exists(manifest_path(tar_path)):
+        return None
+
+    manifest = read_manifest(tar_path)
+    if not isinstance(manifest, dict):
+        return None
+
+    md5sums = manifest.get('md5sums') or {}
+    if ((manifest.get('size'), manifest.get('mtime')) != file_stat(tar_path) or
+            not all(image in md5sums for image in images)):
+        log.log("Verification manifest for {} is out of date".format(tar_path))
+        return None
+    return md5sums
+
+
+def local_path(path):
+    """Return the path in the local file system, or None for a network share."""
+    if path.startswith('special://'):
+        return xbmc.translatePath(path)
+    if '://' in path:
+        return None
+    return path
+
+
+def same_file_system(path1, path2):
+    """Return True if both paths, which must exist, are in the same local
+       file system so that a file can be linked from one to the other."""
+    path1, path2 = local_path(path1), local_path(path2)
+    if path1 is None or path2 is None:
+        return False
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except OSError:
+        return False
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+    except (IOError, OSError):
+        funcs.remove_file(dst)
+        return False
+    return True
+
+
+def link_file(src, dst):
+    """Make dst a hard link to src, or a copy on write clone of it, if they
+       are in the same local file system so that no data is copied.
+       Return False if the file has to be copied."""
+    if not same_file_system(src, os.path.dirname(dst)):
+        return False
+
+    src, dst = local_path(src), local_path(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        log.log("Unable to link {} to {}: {}".format(dst, src, e))
+        if not _reflink(src, dst):
+            return False
+        log.log("Cloned {} to {}".format(src, dst))
+    else:
+        log.log("Linked {} to {}".format(dst, src))
+    return True
+
+
+class ArchiveIndex(object):
+    """A record of the update files in the archive, kept in a small file in
+       the archive root, so that the archive can be kept within its limits
+       after each write without listing its directories.
+
+       Files archived before the index existed are not tracked, and so are
+       never removed, until they are restored from the archive.
+
+       Recipes of tars in the chunk store are counted by the size of the
+       chunks which are freed when they are removed.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, INDEX_NAME)
+        self.entries = self._load()
+        self.store = chunkstore.ChunkStore(os.path.join(root, chunkstore.STORE_NAME))
+
+    def _load(self):
+        if not xbmcvfs.exists(self.path):
+            return {}
+        f = xbmcvfs.File(self.path)
+        try:
+            entries = json.loads(f.read())
+        except ValueError:
+            log.log("Ignoring invalid archive index {}".format(self.path))
+            return {}
+        finally:
+            f.close()
+        return entries if isinstance(entries, dict) else {}
+
+    @log.with_logging(msg_error="Unable to save archive index {0.path}")
+    def save(self):
+        f = xbmcvfs.File(self.path, 'w')
+        try:
+            if not f.write(json.dumps(self.entries)):
+                raise IOError("Write failed")
+        finally:
+            f.close()
+
+    def sources(self):
+        return set(entry['source'] for entry in self.entries.itervalues())
+
+    def latest(self, source):
+        """Return the path of the file most recently archived for the source,
+           or None if there is none."""
+        entries = [(entry['added'], key) for key, entry in self.entries.iteritems()
+                   if entry['source'] == str(source)]
+        if not entries:
+            return None
+        return os.path.join(self.root, max(entries)[1])
+
+    def add(self, source, tar_name, version, size):
+        """Record the archived tar for the build, keeping the time that it was
+           first added if it is already in the index."""
+        key = '/'.join((str(source), tar_name))
+        entry = self.entries.get(key, {'added': time.time()})
+        entry.update(source=str(source), version=version, size=size)
+        self.entries[key] = entry
+
+    @staticmethod
+    def _is_recipe(key):
+        return key.endswith(chunkstore.RECIPE_EXT)
+
+    def _stored_size(self):
+        total = sum(entry['size'] for key, entry in self.entries.iteritems()
+                    if not self._is_recipe(key))
+        if any(self._is_recipe(key) for key in self.entries):
+            total += self.store.stored_size()
+        return total
+
+    def _remove(self, key):
+        """Remove the archived file and return the number of bytes freed,
+           or None if it could not be removed."""
+        path = os.path.join(self.root, key)
+        log.log("Removing {} from the archive".format(path))
+        if not xbmcvfs.exists(path):
+            freed = 0 if self._is_recipe(key) else self.entries[key]['size']
+        elif self._is_recipe(key):
+            try:
+                freed = self.store.remove(path)
+            except (IOError, ValueError) as e:
+                log.log("Unable to remove {}: {}".format(path, e))
+                return None
+        elif xbmcvfs.delete(path):
+            freed = self.entries[key]['size']
+        else:
+            log.log("Unable to remove {}".format(path))
+            return None
+        remove_manifest(path)
+        del self.entries[key]
+        return freed
+
+    def enforce(self, max_size, max_count, keep, last_installs):
+        """Remove the least recently installed files until the archive is no
+           bigger than max_size bytes and has no more than max_count files for
+           each source. A limit of 0 means no limit.
+
+           keep is a set of the (source, version) of builds never to remove
+           and last_installs is a dictionary of install times, as returned by
+           history.get_last_install_times. Files of builds which have not
+           been installed are ordered by the time that they were archived.
+        """
+        def last_used(item):
+            key, entry = item
+            installed = last_installs.get((entry['source'], entry['version']))
+            if installed is not None:
+                return max(time.mktime(installed.timetuple()), entry['added'])
+            return entry['added']
+
+        total = self._stored_size()
+        counts = Counter(entry['source'] for entry in self.entries.itervalues())
+        removable = [item for item in self.entries.iteritems()
+                     if (item[1]['source'], item[1]['version']) not in keep]
+
+        for key, entry in sorted(removable, key=last_used):
+            over_size = max_size and total > max_size
+            over_count = max_count and counts[entry['source']] > max_count
+            if over_size or over_count:
+                freed = self._remove(key)
+                if freed is not None:
+                    total -= freed
+                    counts[entry['source']] -= 1
+
+        if max_size and total > max_size:
+            log.log("Archive is over its size limit but no more builds can be removed")
+
+
+class FileTarget(object):
+    """Writes an archived tar to a temporary file which is renamed into place
+       when it is committed."""
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = path + PART_EXT
+        self._file = xbmcvfs.File(self.temp_path, 'w')
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def commit(self):
+        return xbmcvfs.rename(self.temp_path, self.path)
+
+    def discard(self):
+        xbmcvfs.delete(self.temp_path)
+
+
+class ArchiveWriter(object):
+    """Writes a copy of the update tar to the archive on a thread while the
+       local tar file is written, so that archiving takes no extra pass.
+       The target is a FileTarget by default, or a chunkstore.RecipeWriter.
+
+       The data waits in a bounded buffer so that a slow archive share never
+       holds up the local write. If the buffer fills up or a write to the
+       archive fails the partial archive file is removed and the copy is
+       abandoned, which leaves the tar to be archived after the download.
+    """
+    MAX_BUFFER_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, path, max_buffer_size=MAX_BUFFER_SIZE, target=None):
+        self.path = path
+        self.target = target if target is not None else FileTarget(path)
+        self.max_buffer_size = max_buffer_size
+        self.failed = False
+
+        self._chunks = deque()
+        self._buffered = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fail(self, reason):
+        # Must be called with the lock held.
+        if not self.failed:
+            log.log("Abandoning copy to archive: {}".format(reason))
+            self.failed = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+    def write(self, data):
+        with self._cond:
+            if self.failed or not data:
+                return
+            if self._buffered + len(data) > self.max_buffer_size:
+                self._fail("archive buffer is full")
+                return
+            self._chunks.append(data)
+            self._buffered += len(data)
+            self._cond.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not (self._chunks or self._closed or self.failed):
+                        self._cond.wait()
+                    if self.failed or not self._chunks:
+                        break
+                    data = self._chunks.popleft()
+                try:
+                    written = self.target.write(data)
+                except Exception as e:
+                    written, error = False, e
+                else:
+                    error = "write failed"
+                with self._cond:
+                    self._buffered -= len(data)
+                    if not written:
+                        self._fail(error)
+        finally:
+            self.target.close()
+
+    def _finish(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def close(self):
+        """Wait for the buffered data to be written and move the archive file
+           into place. Return True if the tar was archived."""
+        if self._closed:
+            return not self.failed
+        self._finish()
+        if not self.failed:
+            try:
+                committed = self.target.commit()
+            except Exception as e:
+                committed = False
+                log.log("Unable to commit {}: {}".format(self.path, e))
+            if committed:
+                log.log("Archived tar file to {}".format(self.path))
+                return True
+            with self._cond:
+                self._fail("unable to commit {}".format(self.path))
+        self.target.discard()
+        return False
+
+    def abort(self):
+        """Abandon the copy and remove the partial archive file, unless it
+           has already been closed."""
+        if self._closed:
+            return
+        with self._cond:
+            self._fail("update file is incomplete")
+        self._finish()
+        self.target.discard()
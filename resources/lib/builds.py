@@ -6,46 +6,136 @@ import _strptime
 
 import time
 import re
+import threading
 import os
+import json
+import codecs
+import hashlib
+import urllib
 import urlparse
 from datetime import datetime
 from collections import OrderedDict
+from operator import attrgetter
 from urllib2 import unquote
+from HTMLParser import HTMLParser
 
 from bs4 import BeautifulSoup, SoupStrainer
 import requests
+from requests.adapters import HTTPAdapter
 import html2text
 
-import openelec, funcs, log
+import openelec, funcs, log, httpcache, decompress
 
 
 timeout = None
+retries = 2
 arch = openelec.ARCH
 date_fmt = '%d %b %y'
+cache_dir = None
+
+_response_cache = None
+_details_cache = None
+_session = None
+
+sort_key = attrgetter('sort_key')
+
+INFO_THREADS = 4
+INFO_TIMEOUT = 60
+
+SNAPSHOT_DIR = 'snapshots'
 
 
 class BuildURLError(Exception):
     pass
 
 
+class Session(requests.Session):
+    """Session shared by all requests so that connections are kept alive and
+       reused for each host. Applies the module timeout to every request.
+    """
+    POOL_CONNECTIONS = 8
+    POOL_MAXSIZE = 4
+
+    def __init__(self):
+        super(Session, self).__init__()
+        self._adapter = HTTPAdapter(pool_connections=self.POOL_CONNECTIONS,
+                                    pool_maxsize=self.POOL_MAXSIZE,
+                                    max_retries=retries)
+        self.mount('http://', self._adapter)
+        self.mount('https://', self._adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', timeout)
+        return super(Session, self).request(method, url, **kwargs)
+
+    def connection_stats(self):
+        """Return the number of connections opened and reused."""
+        opened = num_requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            num_requests += pool.num_requests
+        return opened, num_requests - opened
+
+
+def session():
+    """Return the shared session, creating it on first use."""
+    global _session
+    if _session is None:
+        _session = Session()
+    return _session
+
+
+def log_stats():
+    if _session is not None:
+        log.log("HTTP connections opened: {}, reused: {}".format(
+            *_session.connection_stats()))
+    log.log("Build listing cache hits: {}, misses: {}".format(
+        BuildsURL.hits, BuildsURL.misses))
+
+
 class Build(object):
     """Holds information about an OpenELEC build and defines how to compare them,
        produce a unique hash for dictionary keys, and print them.
+
+       Uses __slots__ because thousands of builds are created for large listings.
     """
+    __slots__ = ('_version', '_datetime', '_date')
+
     DATETIME_FMT = '%Y%m%d%H%M%S'
+    # Positions of the year, month, day, hour, minute and second in DATETIME_FMT
+    DATETIME_SLICES = ((0, 4), (4, 6), (6, 8), (8, 10), (10, 12), (12, 14))
 
     def __init__(self, _datetime, version):
         self._version = version
+        self._date = None
         if isinstance(_datetime, datetime):
             self._datetime = _datetime
         else:
+            self._datetime = self.parse_datetime(_datetime)
+
+    @classmethod
+    def parse_datetime(cls, datetime_str):
+        """Parse the fixed width DATETIME_FMT string without strptime."""
+        if len(datetime_str) == cls.DATETIME_SLICES[-1][1]:
             try:
-                self._datetime = datetime.strptime(_datetime, self.DATETIME_FMT)
-            except TypeError:
-                # Work around an issue with datetime.strptime when the script
-                # is run a second time.
-                dt = time.strptime(_datetime, self.DATETIME_FMT)[0:6]
-                self._datetime = datetime(*(dt))
+                return datetime(*[int(datetime_str[start:end])
+                                  for start, end in cls.DATETIME_SLICES])
+            except ValueError:
+                pass
+
+        try:
+            return datetime.strptime(datetime_str, cls.DATETIME_FMT)
+        except TypeError:
+            # Work around an issue with datetime.strptime when the script
+            # is run a second time.
+            dt = time.strptime(datetime_str, cls.DATETIME_FMT)[0:6]
+            return datetime(*(dt))
+
+    @property
+    def sort_key(self):
+        return self._datetime
 
     def __eq__(self, other):
         return (self._version, self._datetime) == (other._version, other._datetime)
@@ -69,36 +159,97 @@ class Build(object):
 
     @property
     def date(self):
-        return self._datetime.strftime(date_fmt)
+        # Memoize the formatted date as long as the format is unchanged.
+        if self._date is None or self._date[0] != date_fmt:
+            self._date = (date_fmt, self._datetime.strftime(date_fmt))
+        return self._date[1]
 
     @property
     def version(self):
         return self._version
 
+    def to_dict(self):
+        """Return a dictionary which can be stored as JSON and passed to
+           build_from_dict to recreate the build without network access."""
+        _datetime = self._datetime
+        if _datetime is not None:
+            _datetime = _datetime.strftime(Build.DATETIME_FMT)
+        return {'type': 'build', 'version': self.version, 'datetime': _datetime}
+
 
 class Release(Build):
     """Subclass of Build for official releases.
 
        Has additional methods for retrieving datetime information from the git tags.
     """
+    __slots__ = ('release_str', 'release', '_resolved', '_has_date', '_tag_datetime')
+
     DATETIME_FMT = '%Y-%m-%dT%H:%M:%S'
+    DATETIME_SLICES = ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19))
     MIN_VERSION = [3,95,0]
+    TAGS_URL = "http://github.com/{dist}/{dist}.tv/tags"
+    TAGS_FILE = 'tags.json'
     tags = None
+    _tags_refreshed = False
 
-    def __init__(self, version):
+    def __init__(self, version, _datetime=None):
         self.release_str = version
-        self.maybe_get_tags()
-        if version in self.tags:
-            self._has_date = True
-            Build.__init__(self, self.tags[version][:19], version)
-        else:
-            self._has_date = False
+        self._version = version
+        self._date = None
         self.release = [int(p) for p in version.split('.')]
+        # The date is looked up in the release tags only when it is needed,
+        # unless it is already known.
+        self._resolved = _datetime is not None
+        self._has_date = self._resolved
+        self._tag_datetime = _datetime
+
+    def _resolve_date(self):
+        if not self._resolved:
+            # Raises if the tags cannot be retrieved, leaving the date to be
+            # looked up again.
+            self.maybe_get_tags(self.release_str)
+            self._resolved = True
+            try:
+                tag_datetime = Release.tags[self.release_str]
+            except KeyError:
+                log.log("No release tag date for {}".format(self.release_str))
+            else:
+                self._has_date = True
+                self._tag_datetime = self.parse_datetime(tag_datetime[:19])
+
+    @property
+    def _datetime(self):
+        self._resolve_date()
+        return self._tag_datetime
+
+    def __eq__(self, other):
+        # Releases are identified by the version alone so no date is needed.
+        return self._version == other._version
+
+    def __hash__(self):
+        return hash(self._version)
+
+    @property
+    def sort_key(self):
+        # Sort on the version so that listing releases needs no tag dates.
+        return self.release
+
+    def has_date(self):
+        self._resolve_date()
+        return self._has_date
 
     def is_valid(self):
-        return self._has_date and self.release >= self.MIN_VERSION
+        return self.has_date() and self.release >= self.MIN_VERSION
+
+    def __nonzero__(self):
+        # Links are created for all versions from MIN_VERSION and the dates
+        # are looked up later with resolve_dates for the links displayed.
+        return self.release >= self.MIN_VERSION
 
-    __nonzero__ = is_valid
+    def to_dict(self):
+        d = Build.to_dict(self)
+        d['type'] = 'release'
+        return d
 
     @classmethod
     def tag_match(cls, tag, attrs):
@@ -119,25 +270,78 @@ class Release(Build):
                     for tag in iter_contents)
 
     @classmethod
-    def maybe_get_tags(cls):
-        if cls.tags is None:
-            cls.tags = {}
-            releases_url = "http://github.com/{dist}/{dist}.tv/tags".format(
-                                dist=openelec.dist())
-            html = requests.get(releases_url).text
-            while True:
-                cls.tags.update(cls.get_tags_page_dict(html))
-                soup = BeautifulSoup(html, 'html.parser',
-                                     parse_only=SoupStrainer(cls.pagination_match))
-                next_page_link = soup.find('a', text='Next')
-                if next_page_link:
-                    href = next_page_link['href']
-                    version = [int(p) for p in href.split('=')[-1].split('.')]
-                    if version < cls.MIN_VERSION:
-                        break
-                    html = requests.get(href).text
-                else:
-                    break
+    def get_next_page_url(cls, html):
+        """Return the URL of the next (older) tags page or None if there is no
+           next page or it only has tags older than MIN_VERSION."""
+        soup = BeautifulSoup(html, 'html.parser',
+                             parse_only=SoupStrainer(cls.pagination_match))
+        next_page_link = soup.find('a', text='Next')
+        if next_page_link:
+            href = next_page_link['href']
+            version = [int(p) for p in href.split('=')[-1].split('.')]
+            if version >= cls.MIN_VERSION:
+                return href
+        return None
+
+    @classmethod
+    def get_tags_page(cls, url):
+        return session().get(url).text
+
+    @classmethod
+    def tags_path(cls):
+        if cache_dir is not None:
+            return os.path.join(cache_dir, cls.TAGS_FILE)
+
+    @classmethod
+    def load_tags(cls):
+        path = cls.tags_path()
+        if path is not None:
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                pass
+        return {}
+
+    @classmethod
+    @log.with_logging(msg_error="Unable to save the release tag dates")
+    def save_tags(cls):
+        path = cls.tags_path()
+        if path is not None:
+            funcs.write_json(path, Release.tags)
+
+    @classmethod
+    def refresh_tags(cls):
+        """Scrape the tags pages from the newest until a page with a tag which
+           is already known, and save the updated tags."""
+        url = cls.TAGS_URL.format(dist=openelec.dist())
+        new_tags = 0
+        while url is not None:
+            html = cls.get_tags_page(url)
+            page_tags = cls.get_tags_page_dict(html)
+            known = any(tag in Release.tags for tag in page_tags)
+            new_tags += sum(tag not in Release.tags for tag in page_tags)
+            Release.tags.update(page_tags)
+            if known:
+                break
+            url = cls.get_next_page_url(html)
+
+        Release._tags_refreshed = True
+        log.log("Found {} new release tags".format(new_tags))
+        if new_tags:
+            cls.save_tags()
+
+    @classmethod
+    def maybe_get_tags(cls, version=None):
+        """Load the saved tag dates and only refresh them from GitHub, at most
+           once per process unless it fails, if there are none or the version
+           is unknown."""
+        if Release.tags is None:
+            Release.tags = cls.load_tags()
+        if not Release._tags_refreshed and (not Release.tags or
+                                            (version is not None and
+                                             version not in Release.tags)):
+            cls.refresh_tags()
 
     def __repr__(self):
         return "{}('{}')".format("Release", self.release_str)
@@ -145,6 +349,9 @@ class Release(Build):
 
 class BuildLinkBase(object):
     """Base class for links to builds"""
+    __slots__ = ()
+    LINK_SLOTS = ('url', 'size', 'filename', 'tar_name', 'compressed')
+
     def __init__(self, baseurl, link):
         # Set the absolute URL
         link = link.strip()
@@ -162,8 +369,8 @@ class BuildLinkBase(object):
             self.url = link
 
     def remote_file(self):
-        response = requests.get(self.url, stream=True, timeout=timeout,
-                                headers={'Accept-Encoding': None})
+        response = session().get(self.url, stream=True,
+                                 headers={'Accept-Encoding': None})
         try:
             self.size = int(response.headers['Content-Length'])
         except KeyError:
@@ -174,74 +381,263 @@ class BuildLinkBase(object):
 
         name, ext = os.path.splitext(self.filename)
         self.tar_name = self.filename if ext == '.tar' else name
-        self.compressed = ext == '.bz2'
+        self.compressed = decompress.format_for_filename(self.filename) is not None
 
         return response.raw
 
 
 class BuildLink(Build, BuildLinkBase):
     """Holds information about a link to an OpenELEC build."""
+    __slots__ = BuildLinkBase.LINK_SLOTS
+
     def __init__(self, baseurl, link, datetime_str, revision):
         BuildLinkBase.__init__(self, baseurl, link)
         Build.__init__(self, datetime_str, version=revision)
 
+    def to_dict(self):
+        d = Build.to_dict(self)
+        d['url'] = self.url
+        return d
+
 
 class ReleaseLink(Release, BuildLinkBase):
     """Class for links to OpenELEC release downloads."""
-    def __init__(self, baseurl, link, release):
+    __slots__ = BuildLinkBase.LINK_SLOTS
+
+    def __init__(self, baseurl, link, release, _datetime=None):
         BuildLinkBase.__init__(self, baseurl, link)
-        Release.__init__(self, release)
+        Release.__init__(self, release, _datetime)
+
+    def to_dict(self):
+        d = Release.to_dict(self)
+        d['url'] = self.url
+        return d
+
+
+def response_cache():
+    """Return the on-disk response cache or None if cache_dir is not set."""
+    global _response_cache
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, 'responses')
+    if _response_cache is None or _response_cache.path != path:
+        _response_cache = httpcache.ResponseCache(path)
+    return _response_cache
+
+
+def details_cache():
+    """Return the cache of build details text or None if cache_dir is not set."""
+    global _details_cache
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, 'details.json')
+    if _details_cache is None or _details_cache.path != path:
+        _details_cache = httpcache.LRUCache(path)
+    return _details_cache
 
 
 class BaseExtractor(object):
-    """Base class for all extractors."""
+    """Base class for all extractors.
+
+       Responses are revalidated against the response cache when it is enabled
+       so that an unchanged page is neither downloaded nor parsed again.
+    """
     url = None
+    HEADERS = {'Accept-Encoding': 'gzip'}
 
     def __init__(self, url=None):
         if url is not None:
             self.url = url
 
-    def _response(self):
-        response = requests.get(self.url, timeout=timeout)
+    def _response(self, field='text', stream=False, **match):
+        """Request the URL, conditionally if a cached entry has the field
+           and the match items. Return the response and the cached entry,
+           or None if there is none.
+
+           The entry is returned rather than kept on the extractor because
+           an extractor can be used from more than one thread at a time.
+        """
+        headers = dict(self.HEADERS)
+        cache_entry = None
+        cache = response_cache()
+        if cache is not None:
+            entry = cache.load(self.url)
+            if (entry is not None and field in entry and
+                    all(entry.get(k) == v for k, v in match.items())):
+                cache_entry = entry
+                headers.update(cache.conditional_headers(entry))
+
+        response = session().get(self.url, headers=headers, stream=stream)
         if not response:
             msg = "Build URL error: status {}".format(response.status_code)
             raise BuildURLError(msg)
-        return response
+        return response, cache_entry
+
+    def _not_modified(self, response, cache_entry):
+        if response.status_code == 304 and cache_entry is not None:
+            log.log("Using cached response for {}".format(self.url))
+            return True
+        return False
+
+    def _store(self, response, **fields):
+        cache = response_cache()
+        if cache is not None:
+            cache.store(self.url, response, **fields)
 
     def _text(self):
-        return self._response().text
+        response, cache_entry = self._response()
+        if self._not_modified(response, cache_entry):
+            return cache_entry['text']
+        text = response.text
+        self._store(response, text=text)
+        return text
 
     def _json(self):
-        return self._response().json()
+        return json.loads(self._text())
 
     def __repr__(self):
         return "{}('{}')".format(self.__class__.__name__, self.url)
 
 
 class BuildLinkExtractor(BaseExtractor):
-    """Base class for extracting build links from a URL"""
+    """Base class for extracting build links from a URL.
+
+       The links can be found by one of two engines: 'soup' parses the page
+       with BeautifulSoup and 'scan' scans the anchor tags with regular
+       expressions without building a tree, which is much faster for large
+       directory listings. Only 'scan' generates links while the listing is
+       downloaded; 'soup' parses the whole page before the first link.
+    """
     BUILD_RE = (".*{dist}.*-{arch}-(?:\d+\.\d+-|)[a-zA-Z]+-(\d+)"
-                "-r\d+[a-z]*-g([0-9a-z]+)\.tar(|\.bz2)")
+                "-r\d+[a-z]*-g([0-9a-z]+)\.tar" + decompress.SUFFIX_RE)
     CSS_CLASS = None
+    ENGINE = 'soup'
+    CHUNK_SIZE = 16384
+
+    A_TAG_RE = re.compile(r"<a\s([^>]*)>", re.I)
+    ATTR_RE = re.compile(r"""([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+
+    def __init__(self, url=None, engine=None):
+        super(BuildLinkExtractor, self).__init__(url)
+        self.engine = engine if engine is not None else self.ENGINE
 
     def __iter__(self):
-        html = self._text()
+        for href in self._iter_hrefs():
+            l = self._create_link(href)
+            if l:
+                yield l
+
+    def newest(self, than=None):
+        """Return a link to the newest build if it is newer than the build
+           `than`, otherwise None.
+
+           The hrefs are scanned for the maximum so that only one link is
+           created instead of creating and sorting a link for every build.
+        """
+        best_href = best_key = None
+        for href in self._iter_hrefs():
+            key = self._href_key(href)
+            if best_href is None or key > best_key:
+                best_href, best_key = href, key
+
+        if best_href is not None:
+            link = self._create_link(best_href)
+            if link and is_newer(link, than):
+                return link
+        return None
+
+    def _href_key(self, href):
+        # The datetime strings in a listing have the same width so they sort
+        # in the same order as the datetimes.
+        return self.build_re.match(href).group(1)
+
+    def _iter_hrefs(self):
+        self.build_re = re.compile(self.BUILD_RE.format(dist=openelec.dist(), arch=arch), re.I)
+
+        # The matching hrefs are cached rather than the page itself so that
+        # an unchanged listing does not need to be parsed again.
+        response, cache_entry = self._response('hrefs', stream=self.engine == 'scan',
+                                               pattern=self.build_re.pattern)
+        if self._not_modified(response, cache_entry):
+            hrefs = cache_entry['hrefs']
+        elif self.engine == 'scan':
+            hrefs = self._stream_hrefs(response)
+        else:
+            hrefs = list(self._hrefs(response.text))
+            self._store(response, hrefs=hrefs, pattern=self.build_re.pattern)
+        return hrefs
+
+    def _stream_hrefs(self, response):
+        """Generate the hrefs while the listing is still being downloaded."""
+        hrefs = []
+        for href in self._scan_hrefs(self._iter_text(response)):
+            hrefs.append(href)
+            yield href
+        self._store(response, hrefs=hrefs, pattern=self.build_re.pattern)
+
+    def _iter_text(self, response):
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')('replace')
+        for chunk in response.iter_content(self.CHUNK_SIZE):
+            yield decoder.decode(chunk)
+        yield decoder.decode('', True)
+
+    def _hrefs(self, html):
         args = ['a']
         if self.CSS_CLASS is not None:
             args.append(self.CSS_CLASS)
 
-        self.build_re = re.compile(self.BUILD_RE.format(dist=openelec.dist(), arch=arch), re.I)
-
         soup = BeautifulSoup(html, 'html.parser',
                              parse_only=SoupStrainer(*args, href=self.build_re))
 
         for link in soup.contents:
-            l = self._create_link(link)
-            if l:
-                yield l
-
-    def _create_link(self, link):
-        href = link['href']
+            yield link['href']
+
+    def _scan_hrefs(self, chunks):
+        """Generate the matching hrefs from an iterable of chunks of HTML.
+
+           Only the text after the last tag opening in a chunk is held back
+           so memory use does not depend on the size of the listing.
+        """
+        pending = u''
+        for chunk in chunks:
+            pending += chunk
+            end = pending.rfind('<')
+            if end == -1:
+                pending = u''
+            elif end > 0:
+                for href in self._scan_text(pending[:end]):
+                    yield href
+                pending = pending[end:]
+
+        for href in self._scan_text(pending):
+            yield href
+
+    def _scan_text(self, html):
+        unescape = HTMLParser().unescape
+        for tag in self.A_TAG_RE.finditer(html):
+            attrs_str = tag.group(1)
+            # Most anchors in a listing are for other builds so rule them out
+            # before parsing the attributes.
+            if not self.build_re.search(attrs_str):
+                continue
+
+            attrs = {}
+            for attr in self.ATTR_RE.finditer(attrs_str):
+                name, double, single, unquoted = attr.groups()
+                value = next(v for v in (double, single, unquoted) if v is not None)
+                if '&' in value:
+                    value = unescape(value)
+                attrs[name.lower()] = value
+
+            href = attrs.get('href')
+            if href is None or not self.build_re.search(href):
+                continue
+            if (self.CSS_CLASS is not None and
+                    self.CSS_CLASS not in attrs.get('class', '').split()):
+                continue
+            yield href
+
+    def _create_link(self, href):
         return BuildLink(self.url, href, *self.build_re.match(href).groups()[:2])
 
 
@@ -254,26 +650,28 @@ class ReleaseLinkExtractor(BuildLinkExtractor):
 
        Overrides _create_link to return a ReleaseLink for each link.
     """
-    BUILD_RE = ".*{dist}.*-{arch}-([\d\.]+)\.tar(|\.bz2)"
+    BUILD_RE = ".*{dist}.*-{arch}-([\d\.]+)\.tar" + decompress.SUFFIX_RE
     BASE_URL = None
 
-    def _create_link(self, link):
-        href = link['href']
+    def _create_link(self, href):
         baseurl = self.BASE_URL if self.BASE_URL is not None else self.url
         return ReleaseLink(baseurl, href, self.build_re.match(href).group(1))
 
+    def _href_key(self, href):
+        return [int(p) for p in self.build_re.match(href).group(1).split('.')]
+
 
 class OfficialReleaseLinkExtractor(ReleaseLinkExtractor):
     BASE_URL = "http://releases.{dist}.tv".format(dist=openelec.dist())
 
 
 class DualAudioReleaseLinkExtractor(ReleaseLinkExtractor):
-    BUILD_RE = ".*{dist}-{arch}.DA-([\d\.]+)\.tar(|\.bz2)"
+    BUILD_RE = ".*{dist}-{arch}.DA-([\d\.]+)\.tar" + decompress.SUFFIX_RE
 
 
 class MilhouseBuildLinkExtractor(BuildLinkExtractor):
     BUILD_RE = ("{dist}-{arch}-(?:\d+\.\d+-|)"
-                "Milhouse-(\d+)-(?:r|%23)(\d+[a-z]*)-g[0-9a-z]+\.tar(|\.bz2)")
+                "Milhouse-(\d+)-(?:r|%23)(\d+[a-z]*)-g[0-9a-z]+\.tar" + decompress.SUFFIX_RE)
 
 
 class BuildInfo(object):
@@ -295,10 +693,25 @@ class BuildDetailsExtractor(BaseExtractor):
 class MilhouseBuildDetailsExtractor(BuildDetailsExtractor):
     """Class for extracting the full build details for a Milhouse build.
        from the release post on the Kodi forum.
+
+       The text is cached by post id because it is slow to retrieve and
+       convert, and a release post does not change.
     """
     def get_text(self):
-        soup = BeautifulSoup(self._text(), 'html.parser')
         pid = urlparse.parse_qs(urlparse.urlparse(self.url).query)['pid'][0]
+        cache = details_cache()
+        if cache is not None:
+            text = cache.get(pid)
+            if text is not None:
+                return text
+
+        text = self._get_text(pid)
+        if cache is not None:
+            cache.set(pid, text)
+        return text
+
+    def _get_text(self, pid):
+        soup = BeautifulSoup(self._text(), 'html.parser')
         post_div_id = "pid_{}".format(pid)
         post = soup.find('div', 'post-body', id=post_div_id)
 
@@ -317,8 +730,11 @@ class MilhouseBuildDetailsExtractor(BuildDetailsExtractor):
 
 class BuildInfoExtractor(BaseExtractor):
     """Default build info extractor class for all build sources which just creates
-       an empty dictionary."""
-    def get_info(self):
+       an empty dictionary.
+
+       get_info is passed the versions of the builds listed so that extractors
+       can look for any which are missing."""
+    def get_info(self, versions=None):
         return {}
 
 
@@ -338,7 +754,7 @@ class MilhouseBuildInfoExtractor(BuildInfoExtractor):
                         yield m.group(1), BuildInfo(m.group(2),
                                                     MilhouseBuildDetailsExtractor(url))
 
-    def get_info(self):
+    def get_info(self, versions=None):
         soup = BeautifulSoup(self._text(), 'html.parser')
         return dict(self._get_info(soup))
 
@@ -367,39 +783,343 @@ def get_milhouse_build_info_extractors():
 
 class CommitInfoExtractor(BuildInfoExtractor):
     """Class used by development build sources for extracting the git commit messages
-       for a commit hash as the summary. Full build details are set to None."""
-    url = "https://api.github.com/repositories/1093060/commits?per_page=100"
+       for a commit hash as the summary. Full build details are set to None.
 
-    def get_info(self):
-        return dict((commit['sha'][:7],
-                     BuildInfo(commit['commit']['message'].split('\n\n')[0], None))
-                     for commit in self._json())
+       The summaries are kept in a local store keyed on the short hash. Only
+       commits newer than the newest stored are fetched, and older commits are
+       only fetched when a listed build's hash is missing.
+
+       If more new commits arrive than are fetched at once, the commits
+       between them and the store are recorded as a gap and fetched on later
+       calls. A hash which is not found when paging back, like one from
+       another branch, is not searched for again until there are new commits.
+    """
+    url = "https://api.github.com/repositories/1093060/commits"
+    PER_PAGE = 100
+    SYNC_PER_PAGE = 20
+    MAX_PAGES = 5
+    STORE_FILE = 'commits.json'
+
+    def _store_path(self):
+        if cache_dir is not None:
+            return os.path.join(cache_dir, self.STORE_FILE)
+
+    def _load_store(self):
+        path = self._store_path()
+        if path is not None:
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                pass
+        return {'commits': {}, 'newest': None, 'oldest': None, 'gaps': [], 'missed': {}}
+
+    @log.with_logging(msg_error="Unable to save the commit store")
+    def _save_store(self, store):
+        path = self._store_path()
+        if path is not None:
+            funcs.write_json(path, store)
+
+    def _get_commits(self, **params):
+        url = "{}?{}".format(self.url, urllib.urlencode(sorted(params.items())))
+        return BaseExtractor(url)._json()
+
+    @staticmethod
+    def _add_commits(store, commits):
+        for commit in commits:
+            summary = commit['commit']['message'].split('\n\n')[0]
+            store['commits'][commit['sha'][:7]] = summary
+
+    def _sync_newer(self, store):
+        """Fetch pages of the newest commits until the newest stored commit."""
+        if store['newest'] is None:
+            commits = self._get_commits(per_page=self.PER_PAGE)
+            if commits:
+                store['oldest'] = commits[-1]['sha']
+        else:
+            commits = []
+            for page in range(1, self.MAX_PAGES + 1):
+                page_commits = self._get_commits(per_page=self.SYNC_PER_PAGE, page=page)
+                shas = [commit['sha'] for commit in page_commits]
+                if store['newest'] in shas:
+                    commits.extend(page_commits[:shas.index(store['newest'])])
+                    break
+                commits.extend(page_commits)
+                if len(page_commits) < self.SYNC_PER_PAGE:
+                    break
+            else:
+                if commits:
+                    store.setdefault('gaps', []).append([commits[-1]['sha'],
+                                                         store['newest']])
+
+        if commits:
+            store['newest'] = commits[0]['sha']
+            self._add_commits(store, commits)
+        return len(commits)
+
+    def _backfill(self, store):
+        """Fetch the commits in the gaps left by _sync_newer, each one paging
+           back from the commit after it until the commit before it."""
+        gaps = store.setdefault('gaps', [])
+        added = 0
+        for _ in range(self.MAX_PAGES):
+            if not gaps:
+                break
+            start, end = gaps[0]
+            commits = self._get_commits(per_page=self.PER_PAGE, sha=start)
+            commits = [c for c in commits if c['sha'] != start]
+            shas = [commit['sha'] for commit in commits]
+            if end in shas:
+                commits = commits[:shas.index(end)]
+            self._add_commits(store, commits)
+            added += len(commits)
+            if end in shas or not commits:
+                gaps.pop(0)
+            else:
+                gaps[0][0] = commits[-1]['sha']
+        return added
+
+    def _missing(self, store, versions):
+        """Return the versions which are not stored and have not already been
+           searched for since the newest commit was stored."""
+        missed = store.setdefault('missed', {})
+        return set(version for version in versions
+                   if version not in store['commits'] and
+                   missed.get(version) != store['newest'])
+
+    def _sync_older(self, store, versions):
+        """Page back from the oldest stored commit while any of the versions
+           are missing, and record the versions which are not found."""
+        missing = self._missing(store, versions)
+        added = 0
+        for _ in range(self.MAX_PAGES):
+            if not missing or store['oldest'] is None:
+                break
+            commits = self._get_commits(per_page=self.PER_PAGE, sha=store['oldest'])
+            # The first commit is the oldest one which is already stored.
+            commits = [c for c in commits if c['sha'] != store['oldest']]
+            if not commits:
+                break
+            store['oldest'] = commits[-1]['sha']
+            self._add_commits(store, commits)
+            missing.difference_update(commit['sha'][:7] for commit in commits)
+            added += len(commits)
+
+        missed = store['missed']
+        for version in list(missed):
+            if version in store['commits']:
+                del missed[version]
+        for version in missing:
+            log.log("Commit {} was not found".format(version))
+            missed[version] = store['newest']
+        return added
+
+    def get_info(self, versions=None):
+        store = self._load_store()
+        added = self._sync_newer(store)
+        added += self._backfill(store)
+        searched = versions is not None and self._missing(store, versions)
+        if searched:
+            added += self._sync_older(store, versions)
+        if added:
+            log.log("Added {} commits to the commit store".format(added))
+        if added or searched:
+            self._save_store(store)
+
+        return dict((sha, BuildInfo(summary, None))
+                    for sha, summary in store['commits'].iteritems())
+
+
+def get_build_infos(info_extractors, versions=None, timeout=INFO_TIMEOUT):
+    """Run the info extractors concurrently on at most INFO_THREADS threads and
+       return their results merged in the order of the extractors.
+
+       An extractor which fails or takes longer than timeout seconds from when
+       it starts is skipped, and its thread slot is given to the next one.
+       Results which arrive after an extractor has timed out are ignored.
+    """
+    results = [None] * len(info_extractors)
+    started = [None] * len(info_extractors)
+    released = set()
+    finished = []
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(INFO_THREADS)
+
+    def release(i):
+        with lock:
+            if i in released:
+                return
+            released.add(i)
+        slots.release()
+
+    def run(i, info_extractor):
+        slots.acquire()
+        try:
+            with lock:
+                if finished:
+                    return
+                started[i] = time.time()
+            try:
+                result = info_extractor.get_info(versions)
+            except Exception as e:
+                log.log("Unable to retrieve build info from {!r}: {}".format(
+                    info_extractor, e))
+            else:
+                with lock:
+                    if i not in released:
+                        results[i] = result
+        finally:
+            release(i)
+
+    threads = []
+    for i, info_extractor in enumerate(info_extractors):
+        thread = threading.Thread(target=run, args=(i, info_extractor))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for i, (thread, info_extractor) in enumerate(zip(threads, info_extractors)):
+        while thread.is_alive():
+            with lock:
+                start = started[i]
+            if start is None:
+                # Waiting for a slot.
+                thread.join(0.1)
+                continue
+            thread.join(max(start + timeout - time.time(), 0))
+            if thread.is_alive():
+                log.log("Timed out retrieving build info from {!r}".format(info_extractor))
+                release(i)
+                break
+
+    with lock:
+        finished.append(True)
+        results = list(results)
+
+    info = {}
+    for result in results:
+        if result is not None:
+            info.update(result)
+    return info
 
 
 class BuildsURL(object):
-    """Class representing a source of builds."""
+    """Class representing a source of builds.
+
+       Listings are memoized for the process for LISTING_TTL seconds, shared
+       between BuildsURL objects for the same URL, extractor and arch.
+    """
+    FIRST_BATCH = 20
+    BATCH = 500
+    LISTING_TTL = 300
+
+    _listings = {}
+    hits = 0
+    misses = 0
+
     def __init__(self, url, subdir=None, extractor=BuildLinkExtractor,
-                 info_extractors=[BuildInfoExtractor()]):
+                 info_extractors=[BuildInfoExtractor()], engine=None):
         self.url = url
         if subdir:
             self.add_subdir(subdir)
 
         self._extractor = extractor
+        self._engine = engine
         self.info_extractors = info_extractors
 
+    def _listing_key(self):
+        return (self.url, self._extractor, arch)
+
+    def _cached_listing(self):
+        try:
+            timestamp, builds = BuildsURL._listings[self._listing_key()]
+        except KeyError:
+            pass
+        else:
+            if time.time() - timestamp < self.LISTING_TTL:
+                BuildsURL.hits += 1
+                return builds
+        BuildsURL.misses += 1
+        return None
+
+    def _cache_listing(self, builds):
+        BuildsURL._listings[self._listing_key()] = (time.time(), list(builds))
+
+    def invalidate(self):
+        """Remove the memoized listing so that the next access fetches it."""
+        BuildsURL._listings.pop(self._listing_key(), None)
+
+    @classmethod
+    def invalidate_all(cls):
+        BuildsURL._listings.clear()
+
     def builds(self):
-        return sorted(self._extractor(self.url), reverse=True)
+        builds = self._cached_listing()
+        if builds is None:
+            builds = sorted(self._extractor(self.url, self._engine), key=sort_key, reverse=True)
+            self._cache_listing(builds)
+        return list(builds)
+
+    def iter_builds(self):
+        """Generate the list of builds, sorted newest first, as it grows while
+           the listing is downloaded. The first list is yielded once there are
+           enough builds to fill a screen, then after every BATCH builds.
+           The same list object is yielded each time.
+
+           The builds only arrive as the listing is downloaded with the 'scan'
+           engine. With 'soup' the whole listing is parsed before the first
+           list. The first list holds the first builds in listing order, which
+           may not be the newest.
+        """
+        builds = self._cached_listing()
+        if builds is not None:
+            yield list(builds)
+            return
+
+        builds = []
+        yielded = 0
+        for build in self._extractor(self.url, self._engine):
+            builds.append(build)
+            if (len(builds) == self.FIRST_BATCH or
+                    (yielded and len(builds) - yielded >= self.BATCH)):
+                builds.sort(key=sort_key, reverse=True)
+                yield builds
+                yielded = len(builds)
+
+        if not yielded or len(builds) != yielded:
+            builds.sort(key=sort_key, reverse=True)
+            yield builds
+
+        self._cache_listing(builds)
 
     def __iter__(self):
-        return iter(self.builds())
+        return iter(resolve_dates(self.builds()))
 
     def latest(self):
         """Return the most recent build or None if no builds are available."""
-        builds = self.builds()
-        try:
-            return builds[0]
-        except IndexError:
-            return None
+        for build in self.builds():
+            if resolve_dates([build]):
+                return build
+        return None
+
+    def newest(self, than=None):
+        """Return the most recent build if it is newer than the build `than`,
+           otherwise None.
+
+           This is cheaper than latest because the listing is not sorted and
+           only the newest link is created, or the memoized listing is used.
+        """
+        listing = self._cached_listing()
+        if listing is not None:
+            build = next((b for b in listing if resolve_dates([b])), None)
+        else:
+            build = self._extractor(self.url, self._engine).newest(than)
+            if isinstance(build, Release) and not build.has_date():
+                build = self.latest()
+
+        if build and is_newer(build, than):
+            return build
+        return None
 
     def add_subdir(self, subdir):
         self._add_slash()
@@ -471,10 +1191,11 @@ def sources():
 
         _sources["Official Releases"] = BuildsURL(
             "http://{dist}.mirrors.uk2.net".format(dist=openelec.dist()),
-            extractor=OfficialReleaseLinkExtractor)
+            extractor=OfficialReleaseLinkExtractor, engine='scan')
 
     _sources["Official Archive"] = BuildsURL(
-        "http://archive.{dist}.tv".format(dist=openelec.dist()), extractor=ReleaseLinkExtractor)
+        "http://archive.{dist}.tv".format(dist=openelec.dist()), extractor=ReleaseLinkExtractor,
+        engine='scan')
 
     _sources["Milhouse Builds"] = MilhouseBuildsURL()
 
@@ -484,9 +1205,9 @@ def sources():
     return _sources
 
 
-def latest_build(source):
+def latest_build(source, than=None):
     """Return the most recent build for the provided source name or None if
-       there is an error. This is used by the service to check for a new build.
+       there is an error or it is not newer than the build `than`.
     """
     build_sources = sources()
     try:
@@ -494,15 +1215,122 @@ def latest_build(source):
     except KeyError:
         return None
     else:
-        return build_url.latest()
+        return build_url.newest(than)
+
+
+def is_newer(build, than):
+    """Return True if the build is newer than the build `than` or `than` is None."""
+    if than is None:
+        return True
+    if isinstance(build, Release) and isinstance(than, Release):
+        # Compare the versions so that no release tag dates are needed.
+        return build.release > than.release
+    return build > than
+
+
+def resolve_dates(builds):
+    """Look up the dates of any releases in the list of builds, refreshing the
+       release tags at most once, and return the builds which have a date.
+
+       Raises requests.RequestException or BuildURLError if the tags cannot
+       be retrieved."""
+    return [build for build in builds
+            if not isinstance(build, Release) or build.has_date()]
+
+
+def build_from_dict(d):
+    """Create a Build or Release, or a link to one if the dictionary has a URL,
+       from a dictionary returned by to_dict."""
+    _datetime = d.get('datetime')
+    if _datetime is not None:
+        _datetime = Build.parse_datetime(_datetime)
+    url = d.get('url')
+    if d['type'] == 'release':
+        if url is not None:
+            return ReleaseLink(url, url, d['version'], _datetime)
+        return Release(d['version'], _datetime)
+    else:
+        if url is not None:
+            return BuildLink(url, url, _datetime, d['version'])
+        return Build(_datetime, d['version'])
+
+
+def _snapshot_path(source):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    name = hashlib.sha1(source).hexdigest() + '.json'
+    return os.path.join(cache_dir, SNAPSHOT_DIR, name)
+
+
+@log.with_logging("Saved snapshot of {}", "Unable to save snapshot of {}")
+def save_snapshot(source, build_url, links, info):
+    """Save the list of build links and the build info for the source so that
+       they can be shown straight away before they are refreshed."""
+    if cache_dir is None:
+        return
+    snapshot = {'url': build_url.url,
+                'arch': arch,
+                'time': time.time(),
+                'builds': [link.to_dict() for link in links],
+                'info': dict((version, {'summary': build_info.summary,
+                                        'details': getattr(build_info.details, 'url', None)})
+                             for version, build_info in info.iteritems())}
+    funcs.write_json(_snapshot_path(source), snapshot)
+
+
+def load_snapshot(source, build_url):
+    """Return the build links and build info saved for the source, or None if
+       there is no snapshot for the current URL and arch."""
+    if cache_dir is None:
+        return None
+    try:
+        with open(_snapshot_path(source)) as f:
+            snapshot = json.load(f)
+        if snapshot['url'] != build_url.url or snapshot['arch'] != arch:
+            return None
+        links = [build_from_dict(d) for d in snapshot['builds']]
+        info = {}
+        for version, build_info in snapshot['info'].iteritems():
+            details = build_info['details']
+            if details is not None:
+                details = MilhouseBuildDetailsExtractor(details)
+            info[version] = BuildInfo(build_info['summary'], details)
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+    log.log("Loaded snapshot of {} from {}".format(
+        source, time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['time']))))
+    return links, info
+
+
+def refresh_snapshot(source, build_url):
+    """Retrieve the builds and build info for the source and save a snapshot."""
+    build_url.invalidate()
+    links = resolve_dates(build_url.builds())
+    info = get_build_infos(build_url.info_extractors, [link.version for link in links])
+    save_snapshot(source, build_url, links, info)
+
+
+def build_from_repr(build_repr):
+    """Create a Build or Release from the repr written to notify files by
+       older versions of the add-on."""
+    m = re.match(r"(Build|Release)\((.*)\)$", build_repr)
+    args = re.findall(r"'([^']*)'", m.group(2))
+    if m.group(1) == "Release":
+        return Release(*args)
+    else:
+        return Build(*args)
 
 
 @log.with_logging(msg_error="Unable to create build object from the notify file")
 def get_build_from_notify_file():
     selected = funcs.read_notify_file()
     if selected:
-        source, build_repr = selected
-        return source, eval(build_repr)
+        source, build = selected
+        if isinstance(build, dict):
+            return source, build_from_dict(build)
+        else:
+            return source, build_from_repr(build)
 
 
 def main():
@@ -511,20 +1339,13 @@ def main():
 
     installed_build = get_installed_build()
 
-    def get_info(build_url):
-        info = {}
-        for info_extractor in build_url.info_extractors:
-            try:
-                info.update(info_extractor.get_info())
-            except Exception as e:
-                print str(e)
-        return info
-
     def print_links(name, build_url):
-        info = get_info(build_url)
         print name
         try:
-            for link in build_url:
+            links = resolve_dates(build_url.builds())
+            info = get_build_infos(build_url.info_extractors,
+                                   [link.version for link in links])
+            for link in links:
                 try:
                     summary = info[link.version]
                 except KeyError:
@@ -0,0 +1,301 @@
+''' Module for storing archived update files as deduplicated chunks '''
+
+from __future__ import division
+
+import os
+import json
+import time
+import hashlib
+
+try:
+    import xbmcvfs
+except ImportError:
+    xbmcvfs = None
+
+import log
+
+
+STORE_NAME = '.chunkstore'
+RECIPE_EXT = '.recipe'
+
+
+# Use xbmcvfs so that the store can be on a network share, or the local
+# file system outside Kodi.
+def _exists(path):
+    if xbmcvfs is None:
+        return os.path.exists(path)
+    return xbmcvfs.exists(path)
+
+
+def _mkdirs(path):
+    if xbmcvfs is None:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    elif not xbmcvfs.mkdirs(path):
+        raise IOError("Unable to create directory {}".format(path))
+
+
+def _delete(path):
+    if xbmcvfs is None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    else:
+        xbmcvfs.delete(path)
+
+
+def _read_file(path):
+    if xbmcvfs is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    f = xbmcvfs.File(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _write_file(path, data):
+    if xbmcvfs is None:
+        with open(path, 'wb') as f:
+            f.write(data)
+        return
+    f = xbmcvfs.File(path, 'w')
+    try:
+        if not f.write(data):
+            raise IOError("Unable to write {}".format(path))
+    finally:
+        f.close()
+
+
+class Chunker(object):
+    """Splits data passed in pieces into content defined chunks, so that data
+       which is inserted or removed only changes the chunks around it.
+
+       A chunk ends after the first occurrence of the marker once it is at
+       least min_size bytes, or at max_size bytes. The marker is found with
+       str.find, which is much faster than a rolling hash in Python. In
+       compressed data, like the SYSTEM image, it occurs every 64 KB on
+       average.
+    """
+    MARKER = '\xa5\x5a'
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 1024 * 1024
+
+    def __init__(self, marker=MARKER, min_size=MIN_SIZE, max_size=MAX_SIZE):
+        self.marker = marker
+        self.min_size = min_size
+        self.max_size = max_size
+        self._buffer = ''
+
+    @property
+    def params(self):
+        return (self.marker, self.min_size, self.max_size)
+
+    def update(self, data):
+        """Return the chunks which are complete."""
+        self._buffer += data
+        chunks = []
+        start = 0
+        while len(self._buffer) - start >= self.min_size:
+            end = self._buffer.find(self.marker, start + self.min_size,
+                                    start + self.max_size)
+            if end == -1:
+                if len(self._buffer) - start < self.max_size:
+                    break
+                end = start + self.max_size
+            else:
+                end += len(self.marker)
+            chunks.append(self._buffer[start:end])
+            start = end
+        self._buffer = self._buffer[start:]
+        return chunks
+
+    def flush(self):
+        chunks = [self._buffer] if self._buffer else []
+        self._buffer = ''
+        return chunks
+
+
+class ChunkStore(object):
+    """Stores each chunk once in a file named after its SHA-1, with a recipe
+       file for each archived tar listing its chunks.
+
+       A reference count of each chunk is kept in an index file in the store
+       so that the chunks which are no longer used can be removed with a
+       recipe without reading the other recipes.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, self.INDEX_NAME)
+        self._chunks = None
+
+    @property
+    def chunks(self):
+        """A dictionary of [size, references] keyed on chunk digest."""
+        if self._chunks is None:
+            self._chunks = {}
+            if _exists(self.index_path):
+                try:
+                    self._chunks = json.loads(_read_file(self.index_path))
+                except ValueError:
+                    log.log("Ignoring invalid chunk store index {}".format(self.index_path))
+        return self._chunks
+
+    def _save(self):
+        _write_file(self.index_path, json.dumps(self.chunks))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def stored_size(self):
+        return sum(size for size, _ in self.chunks.itervalues())
+
+    def logical_size(self):
+        return sum(size * refs for size, refs in self.chunks.itervalues())
+
+    def stats(self):
+        stored = self.stored_size()
+        logical = self.logical_size()
+        return "{} chunks, {} bytes stored for {} bytes archived (dedup ratio {:.2f})".format(
+            len(self.chunks), stored, logical, logical / stored if stored else 1)
+
+    def read_chunk(self, digest, size):
+        """Return the chunk, raising IOError if it is missing or corrupt."""
+        chunk = _read_file(self.chunk_path(digest))
+        if len(chunk) != size or hashlib.sha1(chunk).hexdigest() != digest:
+            raise IOError("Chunk {} is corrupt".format(digest))
+        return chunk
+
+    def writer(self, recipe_path):
+        return RecipeWriter(self, recipe_path)
+
+    def reader(self, recipe_path):
+        return RecipeReader(self, recipe_path)
+
+    def _add_references(self, recipe):
+        chunks = self.chunks
+        for digest, size in recipe:
+            chunks.setdefault(digest, [size, 0])[1] += 1
+        self._save()
+
+    def remove(self, recipe_path):
+        """Remove the recipe and the chunks which no other recipe uses.
+           Return the number of bytes freed."""
+        recipe = json.loads(_read_file(recipe_path))
+        chunks = self.chunks
+        freed = 0
+        for digest, size in recipe['chunks']:
+            entry = chunks.get(digest)
+            if entry is None:
+                continue
+            entry[1] -= 1
+            if entry[1] <= 0:
+                _delete(self.chunk_path(digest))
+                del chunks[digest]
+                freed += size
+        self._save()
+        _delete(recipe_path)
+        log.log("Freed {} bytes in chunk store".format(freed))
+        return freed
+
+
+class RecipeWriter(object):
+    """Splits the data written to it into chunks, stores the chunks which are
+       not already in the store and writes the recipe when it is committed.
+       It can be the target of an archive.ArchiveWriter."""
+    def __init__(self, store, recipe_path):
+        self.store = store
+        self.recipe_path = recipe_path
+        self.size = 0
+        self.new_size = 0
+
+        self._chunker = Chunker()
+        self._recipe = []
+        self._new = set()
+        self._dirs = set()
+
+    def _store(self, chunk):
+        digest = hashlib.sha1(chunk).hexdigest()
+        self._recipe.append((digest, len(chunk)))
+        self.size += len(chunk)
+        if digest in self.store.chunks or digest in self._new:
+            return
+        directory = os.path.dirname(self.store.chunk_path(digest))
+        if directory not in self._dirs:
+            _mkdirs(directory)
+            self._dirs.add(directory)
+        _write_file(self.store.chunk_path(digest), chunk)
+        self._new.add(digest)
+        self.new_size += len(chunk)
+
+    def write(self, data):
+        for chunk in self._chunker.update(data):
+            self._store(chunk)
+        return True
+
+    def close(self):
+        pass
+
+    def commit(self):
+        """Store the rest of the data and write the recipe."""
+        start = time.time()
+        for chunk in self._chunker.flush():
+            self._store(chunk)
+        _write_file(self.recipe_path, json.dumps({'size': self.size,
+                                                  'chunks': self._recipe}))
+        self.store._add_references(self._recipe)
+        log.log("Stored {} of {} bytes as new chunks for {} in {:.1f} s; {}".format(
+            self.new_size, self.size, self.recipe_path, time.time() - start,
+            self.store.stats()))
+        return True
+
+    def discard(self):
+        """Remove the chunks which were stored by this writer."""
+        for digest in self._new:
+            if digest not in self.store.chunks:
+                _delete(self.store.chunk_path(digest))
+        self._new.clear()
+
+
+class RecipeReader(object):
+    """Reads the tar from the chunks in its recipe like a file. Each chunk is
+       checked against its digest and IOError is raised if it is corrupt."""
+    def __init__(self, store, recipe_path):
+        self.store = store
+        recipe = json.loads(_read_file(recipe_path))
+        self._size = recipe['size']
+        self._chunks = iter(recipe['chunks'])
+        self._buffer = ''
+        self._done = 0
+        self._start = time.time()
+
+    def size(self):
+        return self._size
+
+    def _next_chunk(self):
+        for digest, size in self._chunks:
+            return self.store.read_chunk(digest, size)
+        return ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        if not self._buffer and self._done < self._size:
+            raise IOError("Recipe ended after {} of {} bytes".format(self._done, self._size))
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._done += len(data)
+        return data
+
+    def close(self):
+        elapsed = max(time.time() - self._start, 1e-6)
+        log.log("Restored {} bytes from chunk store in {:.1f} s ({:.1f} MB/s)".format(
+            self._done, elapsed, self._done / elapsed / (1024 * 1024)))
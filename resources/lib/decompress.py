@@ -0,0 +1,473 @@
+''' Module for decompressing update files with the fastest available backend '''
+
+import os
+import re
+import bz2
+import zlib
+import time
+import threading
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from binascii import hexlify, unhexlify
+from collections import deque
+
+import log
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# 'process' or 'thread'. bz2 releases the GIL while decompressing so threads
+# are used in Kodi where forking the process is best avoided.
+pool_type = 'process'
+workers = None
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+
+
+def _patterns(magic):
+    """Return the bytes which are fully covered by the 48 bit magic for each
+       of the 8 bit offsets it can start at in a byte."""
+    return [(shift, unhexlify('{:014x}'.format(magic << (8 - shift)))[1:6])
+            for shift in range(8)]
+
+MARKER_PATTERNS = ([('block', shift, pattern) for shift, pattern in _patterns(BLOCK_MAGIC)] +
+                   [('eos', shift, pattern) for shift, pattern in _patterns(EOS_MAGIC)])
+MAGICS = {'block': BLOCK_MAGIC, 'eos': EOS_MAGIC}
+
+
+def _bits(data, start, end):
+    """Return the bits of data between the bit offsets as an integer."""
+    value = int(hexlify(data[start // 8:(end + 7) // 8]), 16)
+    value >>= -end % 8
+    return value & ((1 << (end - start)) - 1)
+
+
+def decompress_block(data, start, end):
+    """Decompress the bz2 block in data between the bit offsets by making it
+       into a stream of its own, with the block CRC as the stream CRC."""
+    nbits = end - start
+    block = _bits(data, start, end)
+    crc = (block >> (nbits - 80)) & 0xffffffff
+    value = (block << 80) | (EOS_MAGIC << 32) | crc
+    nbits += 80
+    pad = -nbits % 8
+    stream = 'BZh9' + unhexlify('{:0{}x}'.format(value << pad, (nbits + pad) // 4))
+    return bz2.decompress(stream)
+
+
+class ParallelBZ2Decompressor(object):
+    """Decompresses a bz2 file which is passed in pieces, like
+       bz2.BZ2Decompressor, but decompresses the blocks on a pool of workers.
+
+       The blocks are found by searching for the block and end of stream
+       magic numbers, which are not byte aligned. Each block is decompressed
+       as a stream of its own and the output is returned in order. The stream
+       CRC is checked against the block CRCs.
+
+       flush must be called after the last piece to get the rest of the
+       output. The pool is then closed and its workers are joined, or they
+       are stopped by close if the decompression is abandoned.
+    """
+    MAX_PENDING_PER_WORKER = 2
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._max_pending = pool._processes * self.MAX_PENDING_PER_WORKER
+        self._pending = deque()
+        self._buffer = ''
+        self._base = 0      # byte offset of the buffer in the file
+        self._scanned = 0   # byte offset of the end of the scanned data
+        self._markers = []
+        self._found = set()
+        self._block_start = None
+        self._stream_crc = 0
+
+    def _scan(self):
+        """Add the markers in the new data, as (bit offset, kind), in order."""
+        buf = self._buffer
+        first = max(self._scanned - self._base - 7, 1)
+        new = []
+        for kind, shift, pattern in MARKER_PATTERNS:
+            i = buf.find(pattern, first)
+            while i != -1 and i + 6 <= len(buf):
+                start = (i - 1) * 8 + shift
+                if (_bits(buf, start, start + 48) == MAGICS[kind] and
+                        self._base * 8 + start not in self._found):
+                    new.append((self._base * 8 + start, kind))
+                i = buf.find(pattern, i + 1)
+        self._scanned = self._base + len(buf) - 6
+        for marker in sorted(new):
+            self._found.add(marker[0])
+            self._markers.append(marker)
+
+    def _bits_at(self, pos, nbits):
+        start = pos - self._base * 8
+        return _bits(self._buffer, start, start + nbits)
+
+    def _dispatch(self):
+        """Submit each block which is followed by a marker and its CRC."""
+        buffer_end = (self._base + len(self._buffer)) * 8
+        while self._markers:
+            pos, kind = self._markers[0]
+            if pos + 80 > buffer_end:
+                break
+            self._markers.pop(0)
+            crc = self._bits_at(pos + 48, 32)
+
+            if self._block_start is not None:
+                start = self._block_start
+                offset = start // 8
+                data = self._buffer[offset - self._base:(pos + 7) // 8 - self._base]
+                self._pending.append(self._pool.apply_async(
+                    decompress_block, (data, start - offset * 8, pos - offset * 8)))
+                self._block_start = None
+
+            if kind == 'block':
+                self._block_start = pos
+                self._stream_crc = (((self._stream_crc << 1) | (self._stream_crc >> 31)) &
+                                    0xffffffff) ^ crc
+            else:
+                if crc != self._stream_crc:
+                    raise IOError("Invalid data stream: CRC mismatch")
+                self._stream_crc = 0
+
+            # Only keep the data from the start of the next block.
+            keep = pos // 8
+            self._buffer = self._buffer[keep - self._base:]
+            self._base = keep
+
+    def _output(self, wait=False):
+        output = []
+        while self._pending and (wait or self._pending[0].ready() or
+                                 len(self._pending) > self._max_pending):
+            output.append(self._pending.popleft().get())
+        return ''.join(output)
+
+    def decompress(self, data):
+        if self._base == 0 and not self._buffer and not data.startswith('BZh'):
+            raise IOError("Invalid data stream")
+        self._buffer += data
+        self._scan()
+        self._dispatch()
+        return self._output()
+
+    def flush(self):
+        try:
+            self._scanned = self._base
+            self._scan()
+            self._dispatch()
+            if self._block_start is not None or self._markers:
+                raise IOError("Compressed file ended before the end of the stream")
+            output = self._output(wait=True)
+        except:
+            self.close()
+            raise
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        return output
+
+    def close(self):
+        """Stop the workers if the decompression did not finish."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+class SerialBZ2Decompressor(object):
+    """The bz2.BZ2Decompressor with a flush method and support for files with
+       more than one stream, as made by parallel compressors."""
+    def __init__(self):
+        self._decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        output = self._decompressor.decompress(data)
+        unused = self._decompressor.unused_data
+        while unused:
+            self._decompressor = bz2.BZ2Decompressor()
+            output += self._decompressor.decompress(unused)
+            unused = self._decompressor.unused_data
+        return output
+
+    def flush(self):
+        return ''
+
+
+def create_pool():
+    """Return a new pool of workers or None if a pool cannot be created."""
+    try:
+        cls = ThreadPool if pool_type == 'thread' else multiprocessing.Pool
+        return cls(workers or multiprocessing.cpu_count())
+    except (OSError, ImportError, NotImplementedError) as e:
+        log.log("Unable to create decompression pool: {}".format(e))
+        return None
+
+
+def bz2_decompressor(parallel=True):
+    """Return a parallel bz2 decompressor if there is more than one core and
+       a pool of workers can be created, otherwise a serial one."""
+    if parallel and (workers or multiprocessing.cpu_count()) > 1:
+        p = create_pool()
+        if p is not None:
+            return ParallelBZ2Decompressor(p)
+    return SerialBZ2Decompressor()
+
+
+class GzipDecompressor(object):
+    """Decompresses gzip files, including files with more than one member."""
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        output = self._decompressor.decompress(data)
+        unused = self._decompressor.unused_data
+        while unused:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output += self._decompressor.decompress(unused)
+            unused = self._decompressor.unused_data
+        return output
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class LZMADecompressor(object):
+    def __init__(self):
+        self._decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+class PipeDecompressor(object):
+    """Decompresses through an external tool, which can use several cores,
+       by writing to its stdin and reading its stdout on a thread."""
+    READ_SIZE = 131072
+
+    def __init__(self, args):
+        self.args = args
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=open(os.devnull, 'w'))
+        self._output = []
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        for data in iter(lambda: self._process.stdout.read(self.READ_SIZE), ''):
+            with self._lock:
+                self._output.append(data)
+
+    def _take_output(self):
+        with self._lock:
+            output, self._output = self._output, []
+        return ''.join(output)
+
+    def decompress(self, data):
+        try:
+            self._process.stdin.write(data)
+        except IOError as e:
+            self._process.wait()
+            raise IOError("{} failed: {}".format(self.args[0], e))
+        return self._take_output()
+
+    def flush(self):
+        self._process.stdin.close()
+        self._reader.join()
+        if self._process.wait() != 0:
+            raise IOError("{} failed with exit status {}".format(
+                self.args[0], self._process.returncode))
+        return self._take_output()
+
+    def close(self):
+        """Stop the tool if the decompression did not finish."""
+        if self._process.poll() is None:
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        self._process.wait()
+        # The reader stops at the end of the output of the killed process.
+        self._reader.join()
+        self._process.stdout.close()
+
+
+def _gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Format(object):
+    """A compression format with its file extension and magic bytes, the
+       external tools to use in order of preference, and the builtin
+       decompressor to use if none of them works.
+
+       Each tool is tried once on sample, an empty compressed file, so that a
+       tool which does not accept the arguments, like busybox xz with -T0,
+       is not used.
+    """
+    def __init__(self, name, ext, magic, sample, tools, builtin=None):
+        self.name = name
+        self.ext = ext
+        self.magic = magic
+        self.sample = sample
+        self.tools = tools
+        self.builtin = builtin
+        self._tool = False
+
+    def _probe(self, args):
+        try:
+            process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=open(os.devnull, 'w'))
+            output = process.communicate(self.sample)[0]
+        except OSError as e:
+            log.log("Unable to run {}: {}".format(args[0], e))
+            return False
+        if process.returncode != 0 or output:
+            log.log("Not using {}: it failed on a test file".format(' '.join(args)))
+            return False
+        return True
+
+    def tool(self):
+        """Return the arguments of the first tool which works, or None."""
+        if self._tool is False:
+            self._tool = next((args for args in self.tools
+                               if find_executable(args[0]) and self._probe(args)), None)
+        return self._tool
+
+    def available(self):
+        """Return True if the format can be decompressed, without running
+           the tools."""
+        return (self.builtin is not None or
+                any(find_executable(args[0]) for args in self.tools))
+
+    def decompressor(self):
+        args = self.tool()
+        if args is not None:
+            backend, decompressor = args[0], PipeDecompressor(args)
+        elif self.builtin is not None:
+            decompressor = self.builtin()
+            backend = type(decompressor).__name__
+        else:
+            raise IOError("No decompressor is available for {} files".format(self.name))
+        log.log("Decompressing {} with {}".format(self.name, backend))
+        return MeasuredDecompressor(decompressor, backend)
+
+
+class MeasuredDecompressor(object):
+    """Logs the throughput of a decompressor after it is flushed."""
+    def __init__(self, decompressor, backend):
+        self._decompressor = decompressor
+        self.backend = backend
+        self._in = self._out = 0
+        self._elapsed = 0
+
+    def _measure(self, func, *args):
+        start = time.time()
+        output = func(*args)
+        self._elapsed += time.time() - start
+        self._out += len(output)
+        return output
+
+    def decompress(self, data):
+        self._in += len(data)
+        return self._measure(self._decompressor.decompress, data)
+
+    def flush(self):
+        output = self._measure(self._decompressor.flush)
+        log.log("{} decompressed {} to {} bytes in {:.1f} s ({:.1f} MB/s)".format(
+            self.backend, self._in, self._out, self._elapsed,
+            self._out / max(self._elapsed, 1e-6) / (1024 * 1024)))
+        return output
+
+    def close(self):
+        close = getattr(self._decompressor, 'close', None)
+        if close is not None:
+            close()
+
+
+FORMATS = (
+    Format('bz2', '.bz2', 'BZh', bz2.compress(''),
+           [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']], bz2_decompressor),
+    Format('gzip', '.gz', '\x1f\x8b', _gzip_compress(''),
+           [['pigz', '-d', '-c']], GzipDecompressor),
+    Format('xz', '.xz', '\xfd7zXZ\x00',
+           unhexlify('fd377a585a000004e6d6b446000000001cdf44211fb6f37d010000000004595a'),
+           [['xz', '-d', '-c', '-T0'], ['xz', '-d', '-c']],
+           LZMADecompressor if lzma is not None else None),
+)
+
+# Matches the compressed file extensions after .tar in the build regexes.
+# Builds in a format which cannot be decompressed here are not offered.
+SUFFIX_RE = "(|{})".format("|".join(re.escape(f.ext) for f in FORMATS if f.available()))
+
+
+def format_for_filename(filename):
+    """Return the Format for the file extension or None if uncompressed."""
+    ext = os.path.splitext(filename)[1]
+    for f in FORMATS:
+        if f.ext == ext:
+            return f
+    return None
+
+
+def format_for_data(data):
+    for f in FORMATS:
+        if data.startswith(f.magic):
+            return f
+    return None
+
+
+class SniffingDecompressor(object):
+    """Chooses the decompressor from the magic bytes at the start of the data."""
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            f = format_for_data(data)
+            if f is None:
+                raise IOError("Unknown compression format")
+            self._decompressor = f.decompressor()
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return ''
+        return self._decompressor.flush()
+
+    def close(self):
+        if self._decompressor is not None:
+            self._decompressor.close()
+
+
+def decompressor(filename=None):
+    """Return a decompressor for the file extension of filename, or one which
+       detects the format from the data. Decompressors have decompress and
+       flush methods and raise IOError if the data is invalid. close releases
+       the workers of a decompression which is abandoned before flush."""
+    if filename is not None:
+        f = format_for_filename(filename)
+        if f is not None:
+            return f.decompressor()
+    return SniffingDecompressor()
@@ -0,0 +1,266 @@
+''' Module for rebuilding an update tar from the chunks which have changed
+    since a build which is available locally '''
+
+from __future__ import division
+
+import json
+import socket
+import hashlib
+import urlparse
+from binascii import hexlify, unhexlify
+
+import requests
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+
+import builds, funcs, log, decompress
+from chunkstore import Chunker
+from script_exceptions import WriteError, DeltaError
+
+
+INDEX_EXT = '.chunks.json'
+READ_SIZE = 1024 * 1024
+
+
+def index_url(build_url):
+    """Return the URL of the chunk index of the tar in a build file, which
+       is next to the uncompressed tar."""
+    f = decompress.format_for_filename(build_url)
+    if f is not None:
+        build_url = build_url[:-len(f.ext)]
+    return build_url + INDEX_EXT
+
+
+def _chunks(path, chunker):
+    """Yield the content defined chunks of the file."""
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), ''):
+            for chunk in chunker.update(data):
+                yield chunk
+    for chunk in chunker.flush():
+        yield chunk
+
+
+def make_index(tar_path, chunker=None):
+    """Return the chunk index of the tar, which lists the SHA-1 and size of
+       each chunk along with the parameters of the chunker."""
+    chunker = chunker or Chunker()
+    chunks = [(hashlib.sha1(chunk).hexdigest(), len(chunk))
+              for chunk in _chunks(tar_path, chunker)]
+    return {'size': sum(size for _, size in chunks),
+            'chunker': {'marker': hexlify(chunker.marker),
+                        'min_size': chunker.min_size,
+                        'max_size': chunker.max_size},
+            'chunks': chunks}
+
+
+def fetch_index(url):
+    """Return the chunk index at the URL, or None if there is no valid index."""
+    try:
+        response = builds.session().get(url)
+        response.raise_for_status()
+        index = response.json()
+        index['size'], index['chunks']
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        log.log("No chunk index at {}: {}".format(url, e))
+        return None
+    return index
+
+
+class DeltaUpdate(object):
+    """Rebuilds an update tar from its chunk index. The chunks which are found
+       in the seed files, like the installed images or an archived tar, or
+       in a chunk store are copied and the rest are fetched from the
+       uncompressed tar with Range requests. Every chunk is checked against
+       its SHA-1 and a local chunk which does not match is fetched instead.
+
+       It has the interface of transfer.Download used by
+       progress.DownloadProgress and passes the tar to an optional
+       verify.TarVerifier as it is written.
+    """
+    def __init__(self, index, index_url, path, verifier=None):
+        self.url = urlparse.urljoin(index_url,
+                                    index.get('url') or index_url[:-len(INDEX_EXT)])
+        self.path = path
+        self.size = index['size']
+        self.offset = self.done = 0
+        self.resumable = False
+        self.verifier = verifier
+        self.fetched = 0
+
+        params = index.get('chunker', {})
+        try:
+            self.chunker_params = (unhexlify(params.get('marker', hexlify(Chunker.MARKER))),
+                                   int(params.get('min_size', Chunker.MIN_SIZE)),
+                                   int(params.get('max_size', Chunker.MAX_SIZE)))
+        except (TypeError, ValueError) as e:
+            raise DeltaError("Invalid chunker in index: {}".format(e))
+
+        self.chunks = []
+        offset = 0
+        for digest, size in index['chunks']:
+            self.chunks.append((digest, size, offset))
+            offset += size
+        if offset != self.size:
+            raise DeltaError("Chunks add up to {} bytes instead of {}".format(offset,
+                                                                             self.size))
+
+        self._needed = set(digest for digest, _, _ in self.chunks)
+        self._sources = {}
+        self._seed_files = {}
+        self._out_f = None
+
+    def add_seed(self, path, update=None):
+        """Find the chunks of the tar in a local file, calling the optional
+           update with the number of bytes read after each chunk. update can
+           raise an exception to stop."""
+        found = 0
+        offset = 0
+        try:
+            for chunk in _chunks(path, Chunker(*self.chunker_params)):
+                digest = hashlib.sha1(chunk).hexdigest()
+                if digest in self._needed and digest not in self._sources:
+                    self._sources[digest] = (path, offset)
+                    found += len(chunk)
+                offset += len(chunk)
+                if update is not None:
+                    update(offset)
+        except IOError as e:
+            log.log("Unable to read {}: {}".format(path, e))
+        log.log("Found {} bytes of the update in {}".format(found, path))
+
+    def add_store(self, store):
+        """Find the chunks of the tar in a chunkstore.ChunkStore, which can
+           only be used if the tar was chunked in the same way."""
+        if self.chunker_params != Chunker().params:
+            return
+        found = 0
+        for digest in self._needed:
+            if digest not in self._sources and digest in store.chunks:
+                self._sources[digest] = store
+                found += store.chunks[digest][0]
+        log.log("Found {} bytes of the update in {}".format(found, store.path))
+
+    @property
+    def fetch_size(self):
+        """The number of bytes which have to be fetched."""
+        return sum(size for digest, size, _ in self.chunks if digest not in self._sources)
+
+    def open(self, raw=None):
+        if raw is not None:
+            raw.close()
+        log.log("Rebuilding {} from {} with {} of {} bytes to fetch".format(
+            self.path, self.url, self.fetch_size, self.size))
+        try:
+            self._out_f = open(self.path, 'wb')
+        except IOError as e:
+            raise WriteError(e)
+
+    def _read_local(self, digest, size, source):
+        """Return the chunk from its local source, or None if it cannot be read
+           or does not match."""
+        try:
+            if isinstance(source, tuple):
+                path, offset = source
+                if path not in self._seed_files:
+                    self._seed_files[path] = open(path, 'rb')
+                f = self._seed_files[path]
+                f.seek(offset)
+                data = f.read(size)
+            else:
+                data = source.read_chunk(digest, size)
+        except IOError as e:
+            log.log("Unable to read chunk {}: {}".format(digest, e))
+            return None
+        if hashlib.sha1(data).hexdigest() != digest:
+            log.log("Local chunk {} has changed".format(digest))
+            return None
+        return data
+
+    def _fetch(self, chunks):
+        """Fetch consecutive chunks with a single Range request."""
+        start = chunks[0][2]
+        end = chunks[-1][2] + chunks[-1][1]
+        response = builds.session().get(
+            self.url, stream=True,
+            headers={'Accept-Encoding': None,
+                     'Range': 'bytes={}-{}'.format(start, end - 1)})
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise DeltaError("{} does not support Range requests".format(self.url))
+            for digest, size, offset in chunks:
+                try:
+                    data = response.raw.read(size)
+                except (Urllib3Error, socket.error) as e:
+                    raise requests.ConnectionError(e)
+                if len(data) != size or hashlib.sha1(data).hexdigest() != digest:
+                    raise DeltaError("Fetched chunk at {} does not match the index".format(
+                        offset))
+                self.fetched += size
+                yield data
+        finally:
+            response.close()
+
+    def _write(self, data):
+        try:
+            self._out_f.write(data)
+        except IOError as e:
+            raise WriteError(e)
+        if self.verifier is not None:
+            self.verifier.update(data)
+        self.done += len(data)
+
+    def run(self, update):
+        i = 0
+        while i < len(self.chunks):
+            digest, size, _ = self.chunks[i]
+            source = self._sources.get(digest)
+            data = None
+            if source is not None:
+                data = self._read_local(digest, size, source)
+            if data is not None:
+                self._write(data)
+                update(self.done)
+                i += 1
+                continue
+
+            # Fetch this chunk along with the next ones which are not local.
+            j = i + 1
+            while j < len(self.chunks) and self.chunks[j][0] not in self._sources:
+                j += 1
+            for data in self._fetch(self.chunks[i:j]):
+                self._write(data)
+                update(self.done)
+            i = j
+
+        log.log("Fetched {} of {} bytes ({:.1%}) for {}".format(
+            self.fetched, self.size, self.fetched / self.size if self.size else 0, self.path))
+
+    def close(self):
+        for f in self._seed_files.itervalues():
+            f.close()
+        self._seed_files.clear()
+        if self._out_f is not None:
+            self._out_f.close()
+            self._out_f = None
+            if self.done < self.size:
+                funcs.remove_file(self.path)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Write the chunk index of update tars '
+                                        'so that they can be used for delta updates')
+    parser.add_argument('tars', nargs='+', metavar='tar', help="uncompressed update tar")
+    parser.add_argument('--url',
+                        help="URL of the tar, if it is not served next to the index")
+    args = parser.parse_args()
+
+    for tar_path in args.tars:
+        index = make_index(tar_path)
+        if args.url:
+            index['url'] = args.url
+        with open(tar_path + INDEX_EXT, 'w') as f:
+            json.dump(index, f)
+        print "Wrote {} with {} chunks".format(tar_path + INDEX_EXT, len(index['chunks']))
@@ -4,6 +4,7 @@ import os
 import sys
 import stat
 import glob
+import json
 
 import log, openelec
 
@@ -48,9 +49,20 @@ def create_empty_file(path):
     open(path, 'w').close()
 
 
+def write_json(path, obj):
+    """Write the object as JSON to a temporary file and rename it into place
+       so that readers never see a partially written file."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(temp_path, path)
+
+
 def create_notify_file(source, build):
-    with open(NOTIFY_FILE, 'w') as f:
-        f.write('\n'.join((str(source), repr(build))))
+    write_json(NOTIFY_FILE, {'source': str(source), 'build': build.to_dict()})
 
 
 def remove_notify_file():
@@ -58,10 +70,21 @@ def remove_notify_file():
 
 
 def read_notify_file():
+    """Return the source and the build dictionary, or the source and the build
+       repr if the file was written by an older version."""
     try:
         with open(NOTIFY_FILE) as f:
-            return f.read().splitlines()
-    except (IOError, ValueError):
+            content = f.read()
+    except IOError:
+        return None
+
+    try:
+        notify = json.loads(content)
+        return notify['source'], notify['build']
+    except (ValueError, KeyError, TypeError):
+        lines = content.splitlines()
+        if len(lines) == 2:
+            return lines
         return None
 
 
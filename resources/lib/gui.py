@@ -76,9 +76,11 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
         except KeyError:
             self._build_url = self._sources.itervalues().next()
             self._initial_source = self._sources.iterkeys().next()
-        self._builds = self._get_build_links(self._build_url)
-
-        self._build_infos = {}
+        self._listing = 0
+        self._selection_moved = False
+        self._prefetched = set()
+        self._builds, self._builds_iter, self._build_infos = self._get_builds(
+            self._initial_source, self._build_url)
 
     def __nonzero__(self):
         return self._selected_build is not None
@@ -99,6 +101,7 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
             self._selected_source_position = self._sources.keys().index(self._initial_source)
 
             self._set_builds(self._builds)
+            self._load_remaining_builds(self._builds_iter)
         else:
             self._selected_source_position = 0
             self._initial_source = self._sources.iterkeys().next()
@@ -131,8 +134,10 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
             self._selected_build = self._builds[self._build_list.getSelectedPosition()]
             self.close()
         elif controlID == self.SOURCE_LIST_ID:
+            source = self._sources_list.getSelectedItem().getLabel()
             self._build_url = self._get_build_url()
-            build_links = self._get_build_links(self._build_url)
+            build_links, builds_iter, build_infos = self._get_builds(source,
+                                                                     self._build_url)
 
             if build_links:
                 self._selected_source_item.setLabel2('')
@@ -141,7 +146,9 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
                 self._selected_source_item.setLabel2('selected')
                 self._selected_source = self._selected_source_item.getLabel()
 
+                self._build_infos = build_infos
                 self._set_builds(build_links)
+                self._load_remaining_builds(builds_iter)
 
                 threading.Thread(target=self._get_and_set_build_info,
                                  args=(self._build_url,)).start()
@@ -165,7 +172,10 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
         if action_id in (xbmcgui.ACTION_MOVE_DOWN, xbmcgui.ACTION_MOVE_UP,
                          xbmcgui.ACTION_PAGE_DOWN, xbmcgui.ACTION_PAGE_UP,
                          xbmcgui.ACTION_MOUSE_MOVE):
+            if self._builds_focused:
+                self._selection_moved = True
             self._set_build_info()
+            self._prefetch_build_details()
 
         elif action_id == xbmcgui.ACTION_SHOW_INFO:
             build_version = self._build_list.getSelectedItem().getLabel()
@@ -205,11 +215,50 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
         elif controlID == self.CANCEL_BUTTON_ID:
             self._info_textbox.setText("[COLOR=white]{}[/COLOR]".format(L10n(32038)))
 
+    def _get_builds(self, source, build_url):
+        """Return the builds to show first, an iterator of the updated lists of
+           builds, and the build info to show until it is retrieved.
+
+           The snapshot saved by the background prefetch is shown straight away
+           if there is one and is replaced once the live listing is retrieved.
+        """
+        snapshot = builds.load_snapshot(source, build_url)
+        if snapshot is not None:
+            links, infos = snapshot
+            if links and self._resolve_installed_date():
+                return links, self._live_builds(build_url), infos
+
+        links, builds_iter = self._get_build_links(build_url)
+        return links, builds_iter, {}
+
+    def _resolve_installed_date(self):
+        """Look up the date of an installed release, which the builds are
+           compared with when they are displayed. Return False if it fails."""
+        try:
+            builds.resolve_dates([self._installed_build])
+        except (requests.RequestException, builds.BuildURLError) as e:
+            log.log("Unable to look up the date of the installed build: {}".format(e))
+            return False
+        return True
+
+    @staticmethod
+    def _live_builds(build_url):
+        # Replace a snapshot with the complete listing rather than with the
+        # first screen of builds.
+        yield build_url.builds()
+
     @utils.showbusy
     def _get_build_links(self, build_url):
+        """Return the first screen of builds and an iterator of the sorted
+           lists of builds while the rest of the listing is downloaded."""
         links = []
+        builds_iter = iter(())
         try:
-            links = build_url.builds()
+            builds_iter = build_url.iter_builds()
+            # Only the dates of the links which are displayed are looked up.
+            first_links = next(builds_iter)
+            builds.resolve_dates([self._installed_build])
+            links = builds.resolve_dates(first_links)
         except requests.ConnectionError as e:
             utils.connection_error(str(e))
         except builds.BuildURLError as e:
@@ -219,17 +268,27 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
         else:
             if not links:
                 utils.bad_url(build_url.url, L10n(32039).format(builds.arch))
-        return links
+        return links, builds_iter
+
+    def _load_remaining_builds(self, builds_iter):
+        self._listing += 1
+        threading.Thread(target=self._update_builds_from,
+                         args=(builds_iter, self._listing)).start()
+
+    def _update_builds_from(self, builds_iter, listing):
+        try:
+            for links in builds_iter:
+                # Stop if another source was selected or the dialog closed.
+                if listing != self._listing:
+                    break
+                self._update_builds(links)
+        except (requests.RequestException, builds.BuildURLError) as e:
+            log.log("Unable to retrieve all builds: {}".format(e))
 
     def _get_build_infos(self, build_url):
         log.log("Retrieving build information")
-        info = {}
-        for info_extractor in build_url.info_extractors:
-            try:
-                info.update(info_extractor.get_info())
-            except Exception as e:
-                log.log("Unable to retrieve build info: {}".format(str(e)))
-        return info
+        return builds.get_build_infos(build_url.info_extractors,
+                                      [build.version for build in self._builds])
 
     def _set_build_info(self):
         if self._builds_focused:
@@ -249,8 +308,33 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
             self._info_textbox.setText(info)
 
     def _get_and_set_build_info(self, build_url):
+        self._prefetched = set()
         self._build_infos = self._get_build_infos(build_url)
         self._set_build_info()
+        self._prefetch_build_details()
+
+    def _prefetch_build_details(self):
+        """Retrieve the details of the selected build and its neighbours in the
+           background so that they are cached before the info key is pressed."""
+        position = self._build_list.getSelectedPosition()
+        for i in (position, position + 1, position - 1):
+            if not 0 <= i < len(self._builds):
+                continue
+            version = self._builds[i].version
+            try:
+                details = self._build_infos[version].details
+            except KeyError:
+                continue
+            if details is not None and version not in self._prefetched:
+                self._prefetched.add(version)
+                threading.Thread(target=self._prefetch, args=(details,)).start()
+
+    @staticmethod
+    def _prefetch(details):
+        try:
+            details.get_text()
+        except Exception as e:
+            log.log("Unable to prefetch build details: {}".format(e))
 
     def _get_build_url(self):
         source = self._sources_list.getSelectedItem().getLabel()
@@ -259,9 +343,37 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
         log.log("Full URL = " + build_url.url)
         return build_url
 
-    def _set_builds(self, builds):
-        self._builds = builds
+    def _set_builds(self, links):
+        self._builds = links
         self._build_list.reset()
+        self._add_build_items(self._builds)
+        self.setFocusId(self.BUILD_LIST_ID)
+        self._builds_focused = True
+        self._selection_moved = False
+
+    def _update_builds(self, links):
+        """Replace the list of builds. The newest build is selected unless
+           the user has moved the selection, in which case the same build
+           stays selected if it is still in the list."""
+        selected_build = None
+        if self._selection_moved:
+            position = self._build_list.getSelectedPosition()
+            if 0 <= position < len(self._builds):
+                selected_build = self._builds[position]
+
+        self._builds = builds.resolve_dates(links)
+        self._build_list.reset()
+        self._add_build_items(self._builds)
+
+        position = 0
+        if selected_build is not None:
+            try:
+                position = self._builds.index(selected_build)
+            except ValueError:
+                pass
+        self._build_list.selectItem(position)
+
+    def _add_build_items(self, builds):
         for build in builds:
             li = xbmcgui.ListItem()
             li.setLabel(build.version)
@@ -274,5 +386,7 @@ class BuildSelectDialog(xbmcgui.WindowXMLDialog):
                 icon = 'installed'
             li.setIconImage("{}.png".format(icon))
             self._build_list.addItem(li)
-        self.setFocusId(self.BUILD_LIST_ID)
-        self._builds_focused = True
+
+    def close(self):
+        self._listing += 1
+        super(BuildSelectDialog, self).close()
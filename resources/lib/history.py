@@ -83,6 +83,30 @@ def get_full_install_history():
                             .format(','.join(FIELDS))).fetchall()
 
 
+@log.with_logging("Retrieved last install times",
+                  "Failed to retrieve last install times")
+def get_last_install_times():
+    """Return a dictionary of the last install time of each build, keyed on
+       (source, version)."""
+    maybe_create_database()
+    last_installs = {}
+    for install in get_full_install_history() or []:
+        key = (install.source, install.version)
+        last_installs[key] = max(install.timestamp, last_installs.get(key, install.timestamp))
+    return last_installs
+
+
+@log.with_logging("Retrieved marked builds",
+                  "Failed to retrieve marked builds")
+def get_marked_builds():
+    """Return the set of (source, version) of the builds which are marked
+       to be kept."""
+    maybe_create_database()
+    with sqlite3.connect(HISTORY_FILE) as conn:
+        return set(conn.execute('''SELECT source, version FROM builds
+                                    WHERE marked''').fetchall())
+
+
 def is_previously_installed(source, build):
     with sqlite3.connect(HISTORY_FILE) as conn:
         return bool(conn.execute('''SELECT COUNT(*) FROM installs WHERE
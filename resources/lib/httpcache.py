@@ -0,0 +1,142 @@
+''' Module for caching HTTP responses on disk between runs '''
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import log, funcs
+
+
+class ResponseCache(object):
+    """Stores response bodies on disk keyed on URL along with the ETag and
+       Last-Modified validators, so that an unchanged page can be revalidated
+       with a conditional GET instead of being downloaded and parsed again.
+
+       The least recently used entries are evicted when the total size of the
+       cache exceeds max_size bytes.
+    """
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _entry_path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() + '.json')
+
+    def load(self, url):
+        """Return the cached entry for the URL as a dictionary or None."""
+        entry_path = self._entry_path(url)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('url') != url:
+            return None
+
+        # Touch the file so that the modification time records the last use.
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return entry
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @log.with_logging(msg_error="Unable to store cached response for {1}")
+    def store(self, url, response, **fields):
+        """Store the fields for the URL if the response can be revalidated."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            self.evict(url)
+            return
+
+        entry = dict(fields, url=url, etag=etag, last_modified=last_modified)
+        with open(self._entry_path(url), 'w') as f:
+            json.dump(entry, f)
+
+        self._enforce_size()
+
+    def evict(self, url):
+        try:
+            os.remove(self._entry_path(url))
+        except OSError:
+            pass
+
+    def _enforce_size(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entry_path = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, entry_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            log.log("Evicting cached response {}".format(entry_path))
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+
+
+class LRUCache(object):
+    """A small least recently used cache of JSON values which is kept in
+       memory and persisted to a single file on every change.
+    """
+    MAX_ITEMS = 50
+
+    def __init__(self, path, max_items=MAX_ITEMS):
+        self.path = path
+        self.max_items = max_items
+        self._items = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._items is None:
+            try:
+                with open(self.path) as f:
+                    self._items = OrderedDict(json.load(f))
+            except (IOError, ValueError, TypeError):
+                self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+    @log.with_logging(msg_error="Unable to save cache {0.path}")
+    def set(self, key, value):
+        with self._lock:
+            self._load()
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+            funcs.write_json(self.path, self._items.items())
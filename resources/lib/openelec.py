@@ -26,6 +26,9 @@ if OS_RELEASE['NAME'] not in ["OpenELEC", "LibreELEC"]:
 
 UPDATE_IMAGES = ('SYSTEM', 'KERNEL')
 
+# Where the installed images are.
+FLASH_DIR = '/flash'
+
 def dist():
     dist = OS_RELEASE['NAME']
     if dist in ("LibreELEC", "OpenELEC"):
@@ -1,15 +1,16 @@
 from __future__ import division
 
 import os
-import bz2
 import time
-import hashlib
 
 import xbmc, xbmcgui, xbmcvfs
 
 from .script_exceptions import Canceled, WriteError, DecompressError
+from . import log
 from .funcs import size_fmt
 from .addon import L10n
+from .verify import TarVerifier
+from . import decompress
 
 
 class Progress(xbmcgui.DialogProgress):
@@ -102,15 +103,53 @@ class FileProgress(object):
         return data
 
 
+class DownloadProgress(FileProgress):
+    """Shows the progress of an opened transfer.Download or transfer.Pipeline,
+       which may use several connections. The partial file is kept if the
+       download fails or is canceled so that it can be resumed."""
+
+    def __init__(self, heading, download, background=False):
+        super(DownloadProgress, self).__init__(heading, download, download.path,
+                                               download.size, background)
+
+    def start(self):
+        self._progress.create(self._heading, self._outfile, size_fmt(self._size))
+
+        start_time = time.time()
+        start_done = self._in_f.offset
+
+        def update(done):
+            if self._progress.iscanceled():
+                raise Canceled
+            percent = int(done * 100 / self._size)
+            bytes_per_second = (done - start_done) / (time.time() - start_time)
+            self._progress.update(percent, "{0}/s".format(size_fmt(bytes_per_second)))
+
+        self._in_f.run(update)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._in_f.close()
+        self._progress.close()
+
+
 class DecompressProgress(FileProgress):
-    decompressor = bz2.BZ2Decompressor()
+    def __init__(self, *args, **kwargs):
+        super(DecompressProgress, self).__init__(*args, **kwargs)
+        self.decompressor = decompress.decompressor()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.decompressor.close()
+        super(DecompressProgress, self).__exit__(exc_type, exc_value, traceback)
+
     def _read(self):
         data = self._getdata()
         try:
             decompressed_data = self.decompressor.decompress(data)
-        except IOError as e:
+            self._done = self._in_f.tell()
+            if not data or self._done >= self._size:
+                decompressed_data += self.decompressor.flush()
+        except (IOError, EOFError) as e:
             raise DecompressError(e)
-        self._done = self._in_f.tell()
         return decompressed_data
     
 
@@ -141,31 +180,71 @@ def reboot_countdown(title, line1, count):
     return timed_out
 
 
-def md5sum_verified(md5sum_compare, path, background):
+def verify_tar(path, background):
+    """Return a TarVerifier updated with the contents of the tar file,
+       or None if canceled."""
     if background:
         verify_progress = ProgressBG()
     else:
         verify_progress = Progress()
 
-    verify_progress.create("Verifying", line1=os.path.basename(path))
+    verify_progress.create(L10n(32018), line1=os.path.basename(path))
 
-    BLOCK_SIZE = 8192
+    BLOCK_SIZE = 131072
 
-    hasher = hashlib.md5()
-    f = open(path)
+    verifier = TarVerifier()
 
     done = 0
     size = os.path.getsize(path)
-    while done < size:
-        if verify_progress.iscanceled():
-            verify_progress.close()
-            return True
-        data = f.read(BLOCK_SIZE)
-        done += len(data)
-        hasher.update(data)
-        percent = int(done * 100 / size)
-        verify_progress.update(percent)
+    with open(path, 'rb') as f:
+        while done < size and not verifier.finished:
+            if verify_progress.iscanceled():
+                verify_progress.close()
+                return None
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            done += len(data)
+            verifier.update(data)
+            percent = int(done * 100 / size)
+            verify_progress.update(percent)
     verify_progress.close()
 
-    md5sum = hasher.hexdigest()
-    return md5sum == md5sum_compare
+    return verifier
+
+
+def find_delta_chunks(update, paths, background, timeout):
+    """Find the chunks of a delta.DeltaUpdate in the local files.
+       Return False if canceled, or if it would take longer than timeout
+       seconds, so that the full build can be downloaded instead."""
+    if background:
+        seed_progress = ProgressBG()
+    else:
+        seed_progress = Progress()
+
+    seed_progress.create(L10n(32148))
+
+    total = sum(os.path.getsize(path) for path in paths) or 1
+    start_time = time.time()
+    before = [0]
+
+    def progress(offset):
+        if seed_progress.iscanceled():
+            raise Canceled
+        done = before[0] + offset
+        elapsed = time.time() - start_time
+        # Give up early if the rate so far shows that it will be too slow.
+        if elapsed > timeout or (elapsed > 5 and elapsed * total / done > timeout):
+            log.log("Finding local chunks would take over {} s".format(timeout))
+            raise Canceled
+        seed_progress.update(int(done * 100 / total))
+
+    try:
+        for path in paths:
+            update.add_seed(path, progress)
+            before[0] += os.path.getsize(path)
+    except Canceled:
+        return False
+    finally:
+        seed_progress.close()
+    return True
@@ -7,5 +7,8 @@ class WriteError(IOError):
 class DecompressError(IOError):
     pass
 
+class DeltaError(IOError):
+    pass
+
 class AlreadyRunning(Exception):
     pass
@@ -0,0 +1,479 @@
+''' Module for downloading build files so that an interrupted download can be
+    resumed in a later run '''
+
+import os
+import json
+import socket
+import threading
+
+import requests
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+
+import builds, funcs, log, decompress
+from script_exceptions import WriteError, DecompressError
+
+
+class Download(object):
+    """A download of a URL to a local file which is used as both the file to
+       read from and the file to write to.
+
+       While the download is incomplete a state file next to it records the
+       URL, the ETag or Last-Modified validator and the number of bytes
+       written, so that the rest can be requested with a Range request if the
+       remote file has not changed.
+    """
+    STATE_EXT = '.state'
+    CHECKPOINT_SIZE = 4 * 1024 * 1024
+    BLOCK_SIZE = 131072
+
+    def __init__(self, url, path, size):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.offset = 0
+        self.done = 0
+        self._raw = None
+        self._out_f = None
+        self._validator = None
+        self._checkpoint = 0
+
+    @property
+    def state_path(self):
+        return self.path + self.STATE_EXT
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if state.get('url') != self.url or state.get('size') != self.size:
+            return None
+        return state
+
+    def _save_state(self):
+        funcs.write_json(self.state_path, {'url': self.url,
+                                           'size': self.size,
+                                           'validator': self._validator,
+                                           'offset': self.done})
+        self._checkpoint = self.done
+
+    def _remove_state(self):
+        if os.path.exists(self.state_path):
+            funcs.remove_file(self.state_path)
+
+    def is_complete(self):
+        """Return True if the file was downloaded completely in a previous run.
+
+           A file with a state file is incomplete even if it has the full size,
+           as a segmented download is preallocated. If the state file is not
+           for this download the file cannot be resumed, so both are removed.
+        """
+        if os.path.exists(self.state_path):
+            if self._load_state() is None:
+                log.log("Removing {} with an unusable state file".format(self.path))
+                funcs.remove_file(self.path)
+                self._remove_state()
+            return False
+        return os.path.isfile(self.path) and os.path.getsize(self.path) == self.size
+
+    @staticmethod
+    def validator(headers):
+        """Return the ETag or Last-Modified header which can be used in an
+           If-Range header, or None."""
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified')
+
+    def resume_offset(self):
+        """Return the number of bytes which can be kept from a previous run."""
+        state = self._load_state()
+        if state is None or not state.get('validator') or 'offset' not in state:
+            return 0
+        try:
+            offset = min(state['offset'], os.path.getsize(self.path))
+        except OSError:
+            return 0
+        return offset if offset < self.size else 0
+
+    def open(self, raw=None):
+        """Request the rest of the file if part of it was downloaded before,
+           or use the raw response if provided, and open the local file.
+        """
+        offset = self.resume_offset()
+        if offset:
+            if raw is not None:
+                raw.close()
+            headers = {'Accept-Encoding': None,
+                       'Range': 'bytes={}-'.format(offset),
+                       'If-Range': self._load_state()['validator']}
+            response = builds.session().get(self.url, stream=True, headers=headers)
+            response.raise_for_status()
+            if response.status_code == 206:
+                log.log("Resuming download of {} at {} bytes".format(self.url, offset))
+            else:
+                log.log("Unable to resume download of {}".format(self.url))
+                offset = 0
+            raw = response.raw
+        elif raw is None:
+            response = builds.session().get(self.url, stream=True,
+                                            headers={'Accept-Encoding': None})
+            response.raise_for_status()
+            raw = response.raw
+
+        self._raw = raw
+        self._validator = self.validator(raw.headers)
+        self.offset = self.done = offset
+
+        try:
+            self._out_f = open(self.path, 'r+b' if offset else 'wb')
+            self._out_f.seek(offset)
+            self._out_f.truncate()
+        except IOError as e:
+            self.close()
+            raise WriteError(e)
+        if self._validator:
+            self._save_state()
+        else:
+            self._remove_state()
+
+    def read(self, size):
+        """Read from the response, raising a ConnectionError if the connection
+           is closed before the end of the file."""
+        try:
+            data = self._raw.read(size)
+        except (Urllib3Error, socket.error) as e:
+            raise requests.ConnectionError(e)
+        if not data and self.done < self.size:
+            raise requests.ConnectionError(
+                "Connection closed after {} of {} bytes".format(self.done, self.size))
+        return data
+
+    def write(self, data):
+        try:
+            self._out_f.write(data)
+        except IOError as e:
+            raise WriteError(e)
+        self.done += len(data)
+        if self._validator and self.done - self._checkpoint >= self.CHECKPOINT_SIZE:
+            self._out_f.flush()
+            self._save_state()
+
+    def tell(self):
+        return self.done
+
+    def run(self, update):
+        """Download the rest of the file, calling update with the number of
+           bytes done after each block. update can raise an exception to
+           stop the download."""
+        while self.done < self.size:
+            self.write(self.read(self.BLOCK_SIZE))
+            update(self.done)
+
+    @property
+    def resumable(self):
+        return self._validator is not None
+
+    def close(self):
+        """Close the files and keep the state if the download is incomplete."""
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+
+        if self._out_f is not None:
+            self._out_f.close()
+            self._out_f = None
+            if self.done >= self.size:
+                self._remove_state()
+            elif self.resumable:
+                self._save_state()
+            else:
+                funcs.remove_file(self.path)
+
+
+class SegmentedDownload(Download):
+    """A download which is split into Range requests for segments of the file
+       which are fetched concurrently into the preallocated file, for servers
+       which limit the rate of each connection.
+
+       The position in each segment is kept in the state file so that the
+       download can be resumed. If the server does not support ranges the
+       file is downloaded with a single connection as for Download.
+    """
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    WAIT = 0.2
+
+    def __init__(self, url, path, size, connections):
+        super(SegmentedDownload, self).__init__(url, path, size)
+        self.connections = connections
+        self.segments = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _save_state(self):
+        if self.segments is None:
+            return super(SegmentedDownload, self)._save_state()
+
+        with self._lock:
+            segments = [list(segment) for segment in self.segments]
+            done = self.done
+        funcs.write_json(self.state_path, {'url': self.url,
+                                           'size': self.size,
+                                           'validator': self._validator,
+                                           'segments': segments})
+        self._checkpoint = done
+
+    def _load_segments(self, validator):
+        """Return the [start, position, end] of each segment from a previous
+           run, or None if there are none for the same remote file."""
+        state = self._load_state()
+        if (state is None or not state.get('segments') or
+                state.get('validator') != validator or
+                not os.path.isfile(self.path) or
+                os.path.getsize(self.path) != self.size):
+            return None
+        return state['segments']
+
+    def _split(self, offset=0):
+        """Split the file after offset into a segment for each connection."""
+        remaining = self.size - offset
+        num = max(1, min(self.connections, remaining // self.MIN_SEGMENT_SIZE))
+        bounds = [offset + remaining * i // num for i in range(num + 1)]
+        segments = [[start, start, end] for start, end in zip(bounds, bounds[1:])]
+        if offset:
+            segments.insert(0, [0, offset, offset])
+        return segments
+
+    def open(self, raw=None):
+        """Split the download into segments if the raw response shows that
+           the server supports ranges, otherwise open it as a single stream."""
+        validator = self.validator(raw.headers) if raw is not None else None
+        segments = self._load_segments(validator) if validator else None
+        if segments is not None:
+            raw.close()
+            self._validator = validator
+            self.segments = segments
+            log.log("Resuming segmented download of {}".format(self.url))
+            resume = True
+        elif (self.connections > 1 and validator and
+                raw.headers.get('Accept-Ranges') == 'bytes' and
+                self.size >= 2 * self.MIN_SEGMENT_SIZE):
+            raw.close()
+            # Keep the part of the file from a single stream download.
+            state = self._load_state()
+            if state is not None and state.get('validator') == validator:
+                offset = self.resume_offset()
+            else:
+                offset = 0
+            self._validator = validator
+            self.segments = self._split(offset)
+            resume = offset > 0
+        else:
+            self.segments = None
+            return super(SegmentedDownload, self).open(raw)
+
+        log.log("Downloading {} in {} segments".format(self.url, len(self.segments)))
+        self.offset = self.done = sum(pos - start for start, pos, end in self.segments)
+        try:
+            self._out_f = open(self.path, 'r+b' if resume else 'wb')
+            self._out_f.truncate(self.size)
+        except IOError as e:
+            self.close()
+            raise WriteError(e)
+        self._save_state()
+
+    def _fetch(self, segment):
+        start, pos, end = segment
+        if pos >= end:
+            return
+        headers = {'Accept-Encoding': None,
+                   'Range': 'bytes={}-{}'.format(pos, end - 1),
+                   'If-Range': self._validator}
+        response = builds.session().get(self.url, stream=True, headers=headers)
+        response.raise_for_status()
+        if response.status_code != 206:
+            response.close()
+            # The file has changed so start again on the next run.
+            self._validator = None
+            raise requests.ConnectionError("Remote file changed during download")
+
+        with open(self.path, 'r+b', 0) as f:
+            f.seek(pos)
+            while pos < end and not self._stop.is_set():
+                try:
+                    data = response.raw.read(min(self.BLOCK_SIZE, end - pos))
+                except (Urllib3Error, socket.error) as e:
+                    raise requests.ConnectionError(e)
+                if not data:
+                    raise requests.ConnectionError(
+                        "Connection closed at {} of segment {}-{}".format(pos, start, end))
+                try:
+                    f.write(data)
+                except IOError as e:
+                    raise WriteError(e)
+                pos += len(data)
+                with self._lock:
+                    segment[1] = pos
+                    self.done += len(data)
+        response.close()
+
+    def _worker(self, segment):
+        try:
+            self._fetch(segment)
+        except Exception as e:
+            log.log("Segment download error: {}".format(e))
+            self._errors.append(e)
+            self._stop.set()
+
+    def run(self, update):
+        if self.segments is None:
+            return super(SegmentedDownload, self).run(update)
+
+        threads = [threading.Thread(target=self._worker, args=(segment,))
+                   for segment in self.segments]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                self._stop.wait(self.WAIT)
+                update(self.done)
+                if self.done - self._checkpoint >= self.CHECKPOINT_SIZE:
+                    self._save_state()
+                if self._errors:
+                    raise self._errors[0]
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        update(self.done)
+
+
+class Pipeline(object):
+    """Decompresses a single stream Download as it arrives, writing the tar
+       file and passing it to an optional verify.TarVerifier, so that the
+       update file is downloaded, decompressed and verified in one pass.
+
+       The compressed data is written to the download file only if the
+       download can be resumed. On the next run the tar file is recreated
+       from it before the rest is downloaded.
+
+       The tar data is also passed to the optional tee, which has write,
+       close and abort methods, to copy it somewhere else at the same time.
+       It is closed when the download completes and aborted otherwise.
+    """
+    def __init__(self, download, tar_path, compressed, verifier=None, tee=None):
+        self.download = download
+        self.tar_path = tar_path
+        self.verifier = verifier
+        self.tee = tee
+        try:
+            self._decompressor = (decompress.decompressor(download.path)
+                                  if compressed else None)
+        except IOError as e:
+            raise DecompressError(e)
+        self._tar_f = None
+        self._keep = True
+
+    @property
+    def path(self):
+        return self.download.path
+
+    @property
+    def size(self):
+        return self.download.size
+
+    @property
+    def offset(self):
+        return self.download.offset
+
+    @property
+    def resumable(self):
+        return self._keep and self.download.resumable
+
+    def open(self, raw=None):
+        try:
+            self.download.open(raw)
+            self._keep = self.download.resumable or self._decompressor is None
+            if self._decompressor is not None:
+                try:
+                    self._tar_f = open(self.tar_path, 'wb')
+                except IOError as e:
+                    raise WriteError(e)
+            if self.download.offset:
+                self._replay()
+        except:
+            self.close()
+            raise
+
+    def _replay(self):
+        """Pass the part of the file downloaded before through the pipeline."""
+        log.log("Processing {} bytes downloaded before".format(self.download.offset))
+        with open(self.download.path, 'rb') as f:
+            left = self.download.offset
+            while left:
+                data = f.read(min(self.download.BLOCK_SIZE, left))
+                if not data:
+                    break
+                left -= len(data)
+                self._process(data)
+
+    def _process(self, data, flush=False):
+        if self._decompressor is not None:
+            try:
+                data = self._decompressor.decompress(data)
+                if flush:
+                    data += self._decompressor.flush()
+            except (IOError, EOFError) as e:
+                raise DecompressError(e)
+            try:
+                self._tar_f.write(data)
+            except IOError as e:
+                raise WriteError(e)
+        if self.tee is not None:
+            self.tee.write(data)
+        if self.verifier is not None:
+            self.verifier.update(data)
+
+    def run(self, update):
+        download = self.download
+        while download.done < download.size:
+            data = download.read(download.BLOCK_SIZE)
+            if self._keep:
+                download.write(data)
+            else:
+                download.done += len(data)
+            self._process(data, flush=download.done >= download.size)
+            update(download.done)
+        if self.tee is not None:
+            self.tee.close()
+
+    def close(self):
+        complete = self.download.done >= self.download.size
+        if self.tee is not None:
+            self.tee.abort()
+        if self._decompressor is not None:
+            self._decompressor.close()
+        self.download.close()
+        if self._tar_f is not None:
+            self._tar_f.close()
+            self._tar_f = None
+            if complete:
+                funcs.remove_file(self.download.path)
+            else:
+                funcs.remove_file(self.tar_path)
+
+
+def create_download(url, path, size, connections=1):
+    """Return a Download, or a SegmentedDownload if more than one connection
+       is to be used."""
+    if connections > 1:
+        return SegmentedDownload(url, path, size, connections)
+    return Download(url, path, size)
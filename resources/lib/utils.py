@@ -186,10 +186,22 @@ def setup_build_check():
         xbmc.executebuiltin(cmd)
 
 
+def setup_prefetch():
+    if addon.get_bool_setting('prefetch'):
+        xbmc.executebuiltin(make_runscript('prefetch'))
+        interval = addon.get_int_setting('check_interval')
+        log.log("Starting build list prefetch timer for every {:d} hour{}"
+                .format(interval, 's' if interval > 1 else ''))
+        cmd = ("AlarmClock(devupdateprefetch, {}, {:02d}:00:00, silent, loop)".
+               format(make_runscript('prefetch'), interval))
+        xbmc.executebuiltin(cmd)
+
+
 def maybe_confirm_installation(selected, installed_build):
     source, selected_build = selected
     log.log("Selected build: {}".format(selected_build))
-    log.log("Installed build: {}".format(installed_build))
+    # Use the repr so that the installed release date is not looked up.
+    log.log("Installed build: {!r}".format(installed_build))
 
     build_str = format_build(selected_build)
     if installed_build == selected_build:
@@ -204,7 +216,7 @@ def maybe_confirm_installation(selected, installed_build):
         log.log(msg.format(selected_build))
 
 
-def add_custom_sources(sources):
+def add_custom_sources(sources, quiet=False):
     for suffix in ('', '_2', '_3'):
         if addon.get_bool_setting('custom_source_enable' + suffix):
             build_type = addon.get_setting('build_type' + suffix)
@@ -225,7 +237,10 @@ def add_custom_sources(sources):
                 custom_url = addon.get_setting('custom_url' + suffix)
                 scheme, netloc = urlparse(custom_url)[:2]
                 if not scheme in ('http', 'https') or not netloc:
-                    bad_url(custom_url, L10n(32066))
+                    if quiet:
+                        log.log_error("Invalid custom source URL '{}'".format(custom_url))
+                    else:
+                        bad_url(custom_url, L10n(32066))
                     continue
 
                 custom_extractors = (builds.BuildLinkExtractor,
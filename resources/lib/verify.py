@@ -0,0 +1,130 @@
+''' Module for verifying the update images in a tar file as it is streamed '''
+
+import os
+import tarfile
+import hashlib
+
+import openelec
+
+
+class TarVerifier(object):
+    """Parses a tar file from the data passed to update, in pieces of any
+       size, and calculates the md5 of each update image as it streams past.
+       The md5 files in the tar are read too so that the images can be
+       verified without extracting them.
+    """
+    BLOCK_SIZE = tarfile.BLOCKSIZE
+    MAX_MD5_FILE_SIZE = 4096
+
+    def __init__(self, images=openelec.UPDATE_IMAGES):
+        self.images = images
+        self.md5sums = {}
+        self.expected = {}
+        self.finished = False
+        self.invalid = False
+
+        self._header = ''
+        self._data_left = 0
+        self._pad_left = 0
+        self._member = None
+        self._long_name = None
+
+    def _match(self, name):
+        """Return the image and whether the member is its md5 file, or None."""
+        for image in self.images:
+            path = os.path.join('target', image)
+            if name.endswith(path):
+                return image, False
+            if name.endswith(path + '.md5'):
+                return image, True
+        return None
+
+    def _start_member(self, header):
+        if header.count('\0') == self.BLOCK_SIZE:
+            self.finished = True
+            return
+
+        try:
+            info = tarfile.TarInfo.frombuf(header)
+        except tarfile.HeaderError:
+            self.finished = self.invalid = True
+            return
+
+        name = info.name
+        if self._long_name is not None:
+            name, self._long_name = self._long_name, None
+
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            self._member = (info.type, [])
+        else:
+            match = self._match(name) if info.isreg() else None
+            if match is None:
+                self._member = None
+            elif match[1]:
+                self._member = ('md5', match[0], [])
+            else:
+                self._member = ('image', match[0], hashlib.md5())
+
+        self._data_left = info.size
+        self._pad_left = -info.size % self.BLOCK_SIZE
+        if not self._data_left:
+            self._end_member()
+
+    def _member_data(self, data):
+        member = self._member
+        if member is None:
+            return
+        if member[0] == 'image':
+            member[2].update(data)
+        else:
+            chunks = member[-1]
+            if sum(len(chunk) for chunk in chunks) < self.MAX_MD5_FILE_SIZE:
+                chunks.append(data)
+
+    def _end_member(self):
+        member, self._member = self._member, None
+        if member is None:
+            return
+
+        kind = member[0]
+        if kind == 'image':
+            self.md5sums[member[1]] = member[2].hexdigest()
+        elif kind == 'md5':
+            fields = ''.join(member[2]).split()
+            if fields:
+                self.expected[member[1]] = fields[0]
+        elif kind == tarfile.GNUTYPE_LONGNAME:
+            self._long_name = ''.join(member[1]).rstrip('\0')
+        else:
+            for record in ''.join(member[1]).splitlines():
+                key, _, value = record.partition(' ')[2].partition('=')
+                if key == 'path':
+                    self._long_name = value
+
+    def update(self, data):
+        pos, end = 0, len(data)
+        while pos < end and not self.finished:
+            if self._data_left:
+                take = min(self._data_left, end - pos)
+                self._member_data(data[pos:pos + take])
+                self._data_left -= take
+                if not self._data_left:
+                    self._end_member()
+            elif self._pad_left:
+                take = min(self._pad_left, end - pos)
+                self._pad_left -= take
+            else:
+                take = min(self.BLOCK_SIZE - len(self._header), end - pos)
+                self._header += data[pos:pos + take]
+                if len(self._header) == self.BLOCK_SIZE:
+                    header, self._header = self._header, ''
+                    self._start_member(header)
+            pos += take
+
+    def verified(self, image):
+        """Return True if the md5 of the image matches its md5 file."""
+        return (not self.invalid and image in self.expected and
+                self.md5sums.get(image) == self.expected[image])
+
+    def mismatches(self):
+        return [image for image in self.images if not self.verified(image)]
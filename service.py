@@ -21,4 +21,6 @@ xbmc.executebuiltin(utils.make_runscript('confirm'))
 
 utils.setup_build_check()
 
+utils.setup_prefetch()
+
 utils.install_cmdline_script()
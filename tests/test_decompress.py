@@ -0,0 +1,47 @@
+''' Tests of the decompressors
+
+    Run with: python -m unittest discover tests
+'''
+
+import os
+import bz2
+import unittest
+from distutils.spawn import find_executable
+
+from resources.lib import decompress
+
+
+class PipeDecompressorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.args = ['bzip2', '-d', '-c']
+        if find_executable(self.args[0]) is None:
+            self.skipTest("{} is not installed".format(self.args[0]))
+        self.data = os.urandom(1024 * 1024)
+        self.compressed = bz2.compress(self.data)
+
+    def test_flush(self):
+        decompressor = decompress.PipeDecompressor(self.args)
+        output = decompressor.decompress(self.compressed)
+        output += decompressor.flush()
+        self.assertTrue(output == self.data)
+        decompressor.close()
+        self.assertEqual(decompressor._process.returncode, 0)
+
+    def test_close_stops_process(self):
+        decompressor = decompress.PipeDecompressor(self.args)
+        decompressor.decompress(self.compressed[:len(self.compressed) // 2])
+        decompressor.close()
+        self.assertFalse(decompressor._process.poll() is None)
+        self.assertTrue(decompressor._process.stdout.closed)
+        self.assertFalse(decompressor._reader.is_alive())
+
+    def test_measured_close(self):
+        decompressor = decompress.MeasuredDecompressor(
+            decompress.PipeDecompressor(self.args), self.args[0])
+        decompressor.decompress(self.compressed[:1000])
+        decompressor.close()
+        self.assertFalse(decompressor._decompressor._process.poll() is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+''' Tests that interrupted downloads are resumed to a complete file
+
+    Run with: python -m unittest discover tests
+'''
+
+import os
+import re
+import bz2
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import requests
+
+from resources.lib import builds, transfer
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's data with Range and If-Range support, cutting the
+       connection at cut_at in the next responses which cover it."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data, etag = server.data, server.etag
+        server.requests.append((self.headers.get('Range'), self.headers.get('If-Range')))
+
+        start, end = 0, len(data) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match and self.headers.get('If-Range') == etag:
+            start = int(match.group(1))
+            end = int(match.group(2) or end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        body = data[start:end + 1]
+        with server.lock:
+            cut = server.cuts > 0 and start < server.cut_at <= end
+            if cut:
+                server.cuts -= 1
+        try:
+            if cut:
+                self.wfile.write(body[:server.cut_at - start])
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                self.close_connection = 1
+            else:
+                self.wfile.write(body)
+        except Exception:
+            self.close_connection = 1
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.set_data(data, '"v1"')
+
+    def handle_error(self, request, client_address):
+        # Clients close connections part way through on purpose.
+        pass
+
+    def set_data(self, data, etag, cuts=0):
+        self.data = data
+        self.etag = etag
+        self.cuts = cuts
+        self.cut_at = len(data) // 2 + 12345
+
+
+class ResumeTestCase(unittest.TestCase):
+    SIZE = 3 * 1024 * 1024 + 123
+
+    def setUp(self):
+        self.data = os.urandom(self.SIZE)
+        self.server = Server(self.data)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/update.tar'.format(self.server.server_port)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'update.tar')
+        transfer.Download.CHECKPOINT_SIZE = 256 * 1024
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def raw(self):
+        return builds.session().get(self.url, stream=True,
+                                    headers={'Accept-Encoding': None}).raw
+
+    def attempt(self, download):
+        """Run the download once and return True if it completed."""
+        try:
+            download.open(self.raw())
+            download.run(lambda done: None)
+        except requests.ConnectionError:
+            return False
+        finally:
+            download.close()
+        return True
+
+    def assertCompleted(self, path, data):
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read() == data, "{} does not match".format(path))
+        self.assertFalse(os.path.exists(path + transfer.Download.STATE_EXT))
+
+    def test_download(self):
+        self.server.cuts = 1
+        self.assertFalse(self.attempt(transfer.Download(self.url, self.path, self.SIZE)))
+
+        download = transfer.Download(self.url, self.path, self.SIZE)
+        self.assertTrue(self.attempt(download))
+        self.assertTrue(download.offset > 0)
+        self.assertEqual(self.server.requests[-1],
+                         ('bytes={}-'.format(download.offset), '"v1"'))
+        self.assertCompleted(self.path, self.data)
+
+    def test_download_changed(self):
+        self.server.cuts = 1
+        self.assertFalse(self.attempt(transfer.Download(self.url, self.path, self.SIZE)))
+
+        data = os.urandom(self.SIZE)
+        self.server.set_data(data, '"v2"')
+        download = transfer.Download(self.url, self.path, self.SIZE)
+        self.assertTrue(self.attempt(download))
+        self.assertEqual(download.offset, 0)
+        self.assertCompleted(self.path, data)
+
+    def test_segmented_download(self):
+        # The first response is only used for its headers.
+        self.server.cuts = 2
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertFalse(self.attempt(download))
+        self.assertTrue(download.segments is not None)
+
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertTrue(self.attempt(download))
+        self.assertTrue(download.offset > 0)
+        self.assertCompleted(self.path, self.data)
+
+    def test_segmented_download_is_complete(self):
+        self.server.cuts = 2
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertFalse(self.attempt(download))
+        # The file is preallocated to the full size.
+        self.assertEqual(os.path.getsize(self.path), self.SIZE)
+        self.assertFalse(download.is_complete())
+
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertTrue(self.attempt(download))
+        self.assertTrue(download.is_complete())
+
+    def test_unusable_state_is_removed(self):
+        self.server.cuts = 2
+        self.assertFalse(self.attempt(
+            transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)))
+
+        download = transfer.SegmentedDownload(self.url + '?other', self.path, self.SIZE, 3)
+        self.assertFalse(download.is_complete())
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(download.state_path))
+
+    def test_segmented_download_changed(self):
+        self.server.cuts = 2
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertFalse(self.attempt(download))
+
+        data = os.urandom(self.SIZE)
+        self.server.set_data(data, '"v2"')
+        download = transfer.SegmentedDownload(self.url, self.path, self.SIZE, 3)
+        self.assertTrue(self.attempt(download))
+        self.assertEqual(download.offset, 0)
+        self.assertCompleted(self.path, data)
+
+    def pipeline(self, data):
+        return transfer.Pipeline(transfer.Download(self.url + '.bz2', self.path + '.bz2',
+                                                   len(data)),
+                                 self.path, True)
+
+    def test_pipeline(self):
+        compressed = bz2.compress(self.data)
+        self.server.set_data(compressed, '"v1"', cuts=1)
+        self.assertFalse(self.attempt(self.pipeline(compressed)))
+        self.assertFalse(os.path.exists(self.path))
+
+        pipeline = self.pipeline(compressed)
+        self.assertTrue(self.attempt(pipeline))
+        self.assertTrue(pipeline.offset > 0)
+        self.assertCompleted(self.path, self.data)
+        self.assertFalse(os.path.exists(self.path + '.bz2'))
+
+    def test_pipeline_open_error(self):
+        class Tee(object):
+            aborted = False
+
+            def abort(self):
+                self.aborted = True
+
+        tee = Tee()
+        compressed = bz2.compress(self.data)
+        self.server.set_data(compressed, '"v1"')
+        path = os.path.join(self.tmp_dir, 'missing', 'update.tar.bz2')
+        pipeline = transfer.Pipeline(transfer.Download(self.url + '.bz2', path,
+                                                       len(compressed)),
+                                     self.path, True, tee=tee)
+        self.assertRaises(transfer.WriteError, pipeline.open, self.raw())
+        self.assertTrue(tee.aborted)
+
+    def test_pipeline_changed(self):
+        compressed = bz2.compress(self.data)
+        self.server.set_data(compressed, '"v1"', cuts=1)
+        self.assertFalse(self.attempt(self.pipeline(compressed)))
+
+        data = os.urandom(self.SIZE)
+        compressed = bz2.compress(data)
+        self.server.set_data(compressed, '"v2"')
+        pipeline = self.pipeline(compressed)
+        self.assertTrue(self.attempt(pipeline))
+        self.assertEqual(pipeline.offset, 0)
+        self.assertCompleted(self.path, data)
+
+
+if __name__ == '__main__':
+    unittest.main()